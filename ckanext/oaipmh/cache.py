@@ -0,0 +1,159 @@
+'''Cache of serialized OAI-PMH responses.
+
+Whole responses are cached for a short time, keyed by the normalized
+request arguments and a validator of the response, the ETag of the
+datasets it's made of. A changed dataset changes the validators of the
+responses it's on, so those are never served from the cache again, in any
+process. Responses without a validator are keyed by a catalogue version
+instead, which is replaced after the commit of any dataset change.
+
+The cache is a Beaker cache configured with ``ckanext.oaipmh.cache.type``
+(default ``memory``), ``.data_dir``, ``.lock_dir`` and ``.url``. Use a
+shared type (``file``, ``ext:memcached``) when running several processes,
+otherwise a new catalogue version is only seen by the process that made
+the change and the other processes serve their responses without a
+validator until ``ckanext.oaipmh.cache.expire`` seconds (default 120, 0
+disables caching) have passed.
+'''
+import hashlib
+import logging
+import uuid
+
+from beaker.cache import CacheManager
+from sqlalchemy import event
+
+from ckan.model import Session
+from ckan.plugins.toolkit import config
+from ckanext.oaipmh.utils import normalize_oai_args
+
+log = logging.getLogger(__name__)
+
+_cache_manager = None
+
+
+def _get_cache_manager():
+    global _cache_manager
+    if _cache_manager is None:
+        options = {'type': config.get('ckanext.oaipmh.cache.type', 'memory')}
+        for option in ('data_dir', 'lock_dir', 'url'):
+            value = config.get('ckanext.oaipmh.cache.%s' % option)
+            if value:
+                options[option] = value
+        _cache_manager = CacheManager(**options)
+    return _cache_manager
+
+
+def get_expire():
+    return int(config.get('ckanext.oaipmh.cache.expire', 120))
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def catalogue_version():
+    '''Return the current catalogue version.'''
+    return _get_cache_manager().get_cache('oaipmh_catalogue').get('version', createfunc=_new_version)
+
+
+def bump_catalogue_version():
+    '''Invalidate all cached responses without a validator.'''
+    _get_cache_manager().get_cache('oaipmh_catalogue').put('version', _new_version())
+
+
+# Session.info key of a transaction which has changed datasets
+CHANGED = 'oaipmh_changed'
+
+
+def _after_commit(session):
+    if session.info.pop(CHANGED, False):
+        bump_catalogue_version()
+
+
+def _after_rollback(session):
+    # Rolling back a savepoint keeps the changes of the enclosing transaction
+    transaction = getattr(session, 'transaction', None)
+    if transaction is not None and transaction.nested:
+        return
+    session.info.pop(CHANGED, None)
+
+
+def setup():
+    '''Listen to the commits of the database session, see
+    :func:`invalidate_after_commit`.
+    '''
+    if not event.contains(Session, 'after_commit', _after_commit):
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_rollback', _after_rollback)
+
+
+def invalidate_after_commit():
+    '''Replace the catalogue version once the current transaction has been
+    committed, so that no response rendered from uncommitted data is cached
+    under the new version. Nothing happens if it's rolled back.
+    '''
+    Session().info[CHANGED] = True
+
+
+def response_key(params, variant=None, validator=None):
+    '''Return the cache key of a response for the given request arguments,
+    representation variant, e.g. content coding, and validator, e.g. ETag.
+    Without a validator, the key depends on the catalogue version.
+    '''
+    version = ('validator', validator) if validator is not None else ('version', catalogue_version())
+    key = repr((version, normalize_oai_args(params), variant))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _responses():
+    return _get_cache_manager().get_cache('oaipmh_responses', expire=get_expire())
+
+
+def cached_response(params, createfunc, variant=None, validator=None):
+    '''Return the cached response for the request arguments, or create it
+    with `createfunc` and cache it.
+
+    :param params: OAI-PMH request arguments
+    :param createfunc: function returning the serialized response
+    :param variant: representation of the response, e.g. content coding
+    :param validator: validator of the datasets the response is made of,
+        computed before the response is created
+    '''
+    if get_expire() <= 0:
+        return createfunc()
+    return _responses().get(key=response_key(params, variant, validator), createfunc=createfunc)
+
+
+def has_response(params, variant=None, validator=None):
+    '''Whether the response for the request arguments is cached or
+    precomputed.
+    '''
+    key = response_key(params, variant, validator)
+    if get_expire() > 0 and _responses().has_key(key):
+        return True
+    return _prefetched().has_key(key)
+
+
+def _prefetched():
+    expire = int(config.get('ckanext.oaipmh.precompute.expire', 60))
+    return _get_cache_manager().get_cache('oaipmh_prefetched', expire=expire)
+
+
+def store_prefetched(params, response, validator=None):
+    '''Park a precomputed response until the request for it arrives.'''
+    _prefetched().put(response_key(params, validator=validator), response)
+    return response
+
+
+def pop_prefetched(params, validator=None):
+    '''Return and forget the precomputed response for the request
+    arguments, or None.
+    '''
+    prefetched = _prefetched()
+    key = response_key(params, validator=validator)
+    try:
+        response = prefetched.get_value(key)
+    except KeyError:
+        return None
+    prefetched.remove_value(key)
+    return response
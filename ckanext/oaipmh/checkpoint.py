@@ -0,0 +1,99 @@
+'''Checkpoints of the ListIdentifiers walk in the gather stage.
+
+After every page the current set, its resumption token and the identifiers
+and datestamps of the page are saved, so that a gather that crashes or times out can be
+continued by the next job instead of starting over.
+'''
+import json
+import logging
+
+from dateutil.parser import parse as dp
+
+from ckan.model import Session
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh.model import GatherCheckpoint
+
+log = logging.getLogger(__name__)
+
+
+def walk_params(set_ids, kwargs):
+    '''Serialize the sets and arguments of a walk for comparison.'''
+    args = dict((key, value.isoformat() if hasattr(value, 'isoformat') else value)
+                for key, value in kwargs.items())
+    return json.dumps([sorted(set_ids or []), args], sort_keys=True)
+
+
+def load(harvest_source_id, params):
+    '''Return the checkpoint of an interrupted walk with the same params,
+    discarding the checkpoint of any other walk.
+
+    :rtype: GatherCheckpoint or None
+    '''
+    checkpoint = GatherCheckpoint.get(harvest_source_id)
+    if checkpoint and checkpoint.params != params:
+        log.info('Discarding gather checkpoint of %s made with other arguments', harvest_source_id)
+        clear(harvest_source_id)
+        checkpoint = None
+    return checkpoint
+
+
+def start(harvest_source_id, params):
+    checkpoint = GatherCheckpoint(harvest_source_id=harvest_source_id, params=params,
+                                  completed_sets=u'[]', watermarks=u'{}')
+    checkpoint.save()
+    return checkpoint
+
+
+def headers(harvest_source_id):
+    '''Yield the identifiers and datestamps gathered before the checkpoint
+    in order.
+    '''
+    table = oaipmh_model.gather_identifier_table
+    query = Session.query(table.c.identifier, table.c.datestamp). \
+        filter(table.c.harvest_source_id == harvest_source_id). \
+        order_by(table.c.id)
+    for identifier, datestamp in query.yield_per(1000):
+        yield identifier, datestamp
+
+
+def save_page(checkpoint, set_spec, resumption_token, page_headers, latest=None):
+    '''Save the identifiers and datestamps of a page and the position after
+    it, and the latest datestamps of each set if given.
+    '''
+    if page_headers:
+        Session.execute(oaipmh_model.gather_identifier_table.insert(),
+                        [{'harvest_source_id': checkpoint.harvest_source_id,
+                          'identifier': identifier, 'datestamp': datestamp}
+                         for identifier, datestamp in page_headers])
+    checkpoint.set_spec = set_spec
+    checkpoint.resumption_token = resumption_token
+    if latest is not None:
+        checkpoint.watermarks = json.dumps(dict((spec, datestamp.isoformat())
+                                                for spec, datestamp in latest.items()))
+    checkpoint.save()
+
+
+def complete_set(checkpoint, set_spec):
+    completed = json.loads(checkpoint.completed_sets)
+    completed.append(set_spec)
+    checkpoint.completed_sets = json.dumps(completed)
+    checkpoint.set_spec = None
+    checkpoint.resumption_token = None
+    checkpoint.save()
+
+
+def completed_sets(checkpoint):
+    return json.loads(checkpoint.completed_sets)
+
+
+def watermarks(checkpoint):
+    '''Return the latest datestamps of each set saved in the checkpoint.'''
+    return dict((spec, dp(datestamp)) for spec, datestamp in json.loads(checkpoint.watermarks or u'{}').items())
+
+
+def clear(harvest_source_id):
+    '''Remove the checkpoint of a harvest source after a finished gather.'''
+    table = oaipmh_model.gather_identifier_table
+    Session.execute(table.delete().where(table.c.harvest_source_id == harvest_source_id))
+    Session.query(GatherCheckpoint).filter(GatherCheckpoint.harvest_source_id == harvest_source_id).delete()
+    Session.commit()
@@ -8,27 +8,11 @@ import oaipmh
 from ckanext.oaipmh import importformats
 from ckanext.oaipmh.cmdi_reader import CmdiReader
 from ckanext.oaipmh.harvester import OAIPMHHarvester
+from ckanext.oaipmh.pids import get_package_id_by_pid
 import ckan.plugins.toolkit as toolkit
 
 log = logging.getLogger(__name__)
 
-def get_package_id_by_pid(pid, pid_type):
-    """ Find pid by id and type.
-    :param pid: id of the pid
-    :param pid_type: type of the pid (primary, relation)
-    :return: id of the package
-    """
-    query = select(['key', 'package_id']).where(and_(model.PackageExtra.value == pid, model.PackageExtra.key.like('pids_%_id'),
-                                                     model.PackageExtra.state == 'active'))
-
-    for key, package_id in [('pids_%s_type' % key.split('_')[1], package_id) for key, package_id in Session.execute(query)]:
-        query = select(['package_id']).where(and_(model.PackageExtra.value == pid_type, model.PackageExtra.key == key,
-                                                  model.PackageExtra.state == 'active', model.PackageExtra.package_id == package_id))
-        for package_id, in Session.execute(query):
-            return package_id
-
-    return None
-
 class CMDIHarvester(OAIPMHHarvester):
     md_format = 'cmdi0571'
     client = None  # used for testing
@@ -48,14 +32,15 @@ class CMDIHarvester(OAIPMHHarvester):
 
     def on_deleted(self, harvest_object, header):
         """ See :meth:`OAIPMHHarvester.on_deleted`
-            Mark package for deletion.
+            Mark package for deletion. The object is committed by the
+            caller, with the rest of its gather chunk or after the fetch.
         """
         package_id = get_package_id_by_pid(header.identifier(), 'primary')
         if package_id:
             harvest_object.package_id = package_id
         harvest_object.content = None
         harvest_object.report_status = "deleted"
-        harvest_object.save()
+        harvest_object.add()
         return True
 
     def gather_stage(self, harvest_job):
@@ -66,7 +51,7 @@ class CMDIHarvester(OAIPMHHarvester):
             harvest_job.source.config = json.dumps(config)
             harvest_job.source.save()
         registry = self.metadata_registry(config, harvest_job)
-        client = self.client or oaipmh.client.Client(harvest_job.source.url, registry)
+        client = self.client or self.create_client(harvest_job.source.url, registry)
         return self.populate_harvest_job(harvest_job, None, config, client)
 
     def parse_xml(self, f, context, orig_url=None, strict=True):
@@ -1,6 +1,7 @@
 from urllib.parse import urlparse
 
 from ckanext.oaipmh.importcore import generic_xml_metadata_reader
+from ckanext.oaipmh.pids import get_package_id_by_pid
 import oaipmh.common
 from first import first
 from ckan.plugins.toolkit import config
@@ -54,23 +55,6 @@ def get_unique_package_id():
         return new_id
     return None
 
-def get_package_id_by_pid(pid, pid_type):
-    """ Find pid by id and type.
-    :param pid: id of the pid
-    :param pid_type: type of the pid (primary, relation)
-    :return: id of the package
-    """
-    query = select(['key', 'package_id']).where(and_(model.PackageExtra.value == pid, model.PackageExtra.key.like('pids_%_id'),
-                                                     model.PackageExtra.state == 'active'))
-
-    for key, package_id in [('pids_%s_type' % key.split('_')[1], package_id) for key, package_id in Session.execute(query)]:
-        query = select(['package_id']).where(and_(model.PackageExtra.value == pid_type, model.PackageExtra.key == key,
-                                                  model.PackageExtra.state == 'active', model.PackageExtra.package_id == package_id))
-        for package_id, in Session.execute(query):
-            return package_id
-
-    return None
-
 class CmdiReaderException(Exception):
     """ Reader exception is thrown on unexpected data or error. """
     pass
@@ -0,0 +1,95 @@
+import logging
+
+from ckan.lib.cli import CkanCommand
+
+log = logging.getLogger(__name__)
+
+
+class OAIPMHCommand(CkanCommand):
+    '''OAI-PMH maintenance commands
+
+    Usage:
+
+        oaipmh index-pids
+            Index the PIDs of all datasets for looking up datasets by PID
+
+        oaipmh import-job {job-id}
+            Fetch and import the waiting objects of a harvest job in
+            batches, e.g. of a source with "batch_import": true in its
+            configuration.
+            The imported datasets are indexed in batches of 1000
+
+        oaipmh resourcesync
+            Write the ResourceSync capability, resource and change lists,
+            e.g. every few minutes from cron
+
+    The commands should be run from the ckanext-oaipmh directory and expect
+    a development.ini file to be present. Most of the time you will
+    specify the config explicitly though::
+
+        paster oaipmh index-pids --config=../ckan/development.ini
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+        from ckanext.oaipmh import model as oaipmh_model, pids, resourcesync
+
+        cmd = self.args[0]
+        if cmd == 'index-pids':
+            oaipmh_model.setup()
+            print('Indexed %d PIDs' % pids.rebuild())
+        elif cmd == 'resourcesync':
+            if not resourcesync.get_public_path():
+                print('ResourceSync publication is disabled, set ckanext.oaipmh.resourcesync.public_path')
+                return
+            resourcesync.setup()
+            published = resourcesync.publish()
+            if published:
+                print('Published %d resources and %d changes' % published)
+            else:
+                print('No changes to publish')
+        elif cmd == 'import-job':
+            if len(self.args) < 2:
+                print('Please provide a harvest job id')
+                return
+            self.import_job(self.args[1])
+        else:
+            print('Command %s not recognized' % cmd)
+            print(self.usage)
+
+    def import_job(self, job_id):
+        from ckan import model
+        from ckan.plugins import PluginImplementations
+        from ckanext.harvest.interfaces import IHarvester
+        from ckanext.harvest.model import HarvestJob, HarvestObject
+        from ckanext.oaipmh.harvester import chunks, IMPORT_CHUNK_SIZE, OAIPMHHarvester
+        from ckanext.oaipmh.indexing import DeferredIndexing
+
+        job = HarvestJob.get(job_id)
+        if not job:
+            print('Harvest job %s not found' % job_id)
+            return
+        harvester = None
+        for plugin in PluginImplementations(IHarvester):
+            if plugin.info()['name'] == job.source.type:
+                harvester = plugin
+        if not isinstance(harvester, OAIPMHHarvester):
+            print('Harvest job %s is not an OAI-PMH harvest job' % job_id)
+            return
+
+        # Objects left to the batch import by the gather stage
+        object_ids = [object_id for object_id, in model.Session.query(HarvestObject.id).
+                      filter(HarvestObject.harvest_job_id == job.id).
+                      filter(HarvestObject.state == 'WAITING').
+                      order_by(HarvestObject.gathered)]
+        imported = 0
+        with DeferredIndexing() as indexing:
+            for ids in chunks(object_ids, IMPORT_CHUNK_SIZE):
+                harvest_objects = model.Session.query(HarvestObject).filter(HarvestObject.id.in_(ids)).all()
+                imported += harvester.import_objects(harvest_objects, indexing=indexing)
+        print('Imported %d of %d objects' % (imported, len(object_ids)))
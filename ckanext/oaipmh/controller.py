@@ -1,17 +1,184 @@
 '''Serving controller interface for OAI-PMH
 '''
+import hashlib
 import logging
+import re
+from xml.sax.saxutils import unescape
 
 import oaipmh.metadata as oaimd
 import oaipmh.server as oaisrv
+from oaipmh.datestamp import datestamp_to_datetime
 from pylons import request, response
+from webob.datetime_utils import UTC
 
 from ckan.lib.base import BaseController, render
-from oaipmh_server import CKANServer
+from oaipmh_server import CKANServer, get_compression
 from rdftools import rdf_reader, dcat2rdf_writer
+from ckan.plugins.toolkit import config
+from ckanext.oaipmh import cache, workers
+from ckanext.oaipmh.utils import compress, normalize_oai_args, SingleFlight
 
 log = logging.getLogger(__name__)
 
+# Identical requests running at the same time in this process share a
+# single computation
+single_flight = SingleFlight()
+
+# Verbs whose responses are made of datasets and can be validated with
+# their modification times
+VALIDATED_VERBS = ('GetRecord', 'ListIdentifiers', 'ListRecords')
+
+# Records per ListIdentifiers/ListRecords page
+RESUMPTION_BATCH_SIZE = 10
+
+RESUMPTION_TOKEN = re.compile(r'<resumptionToken[^>]*>([^<]+)</resumptionToken>')
+
+
+def create_server():
+    '''Return a batching OAI-PMH server for CKAN.'''
+    client = CKANServer()
+    metadata_registry = oaimd.MetadataRegistry()
+    metadata_registry.registerReader('oai_dc', oaimd.oai_dc_reader)
+    metadata_registry.registerWriter('oai_dc', oaisrv.oai_dc_writer)
+    metadata_registry.registerReader('rdf', rdf_reader)
+    metadata_registry.registerWriter('rdf', dcat2rdf_writer)
+    return oaisrv.BatchingServer(client,
+                                 metadata_registry=metadata_registry,
+                                 resumption_batch_size=RESUMPTION_BATCH_SIZE)
+
+
+def handle_request(parms, validator=None):
+    '''Return the response for the request arguments, using a precomputed
+    page if there is one. Identical concurrent requests with the same
+    validator, including a running precomputation, share a single
+    computation.
+    '''
+    def compute():
+        prefetched = cache.pop_prefetched(parms, validator)
+        if prefetched is not None:
+            return prefetched
+        return create_server().handleRequest(parms)
+    return single_flight.do((normalize_oai_args(parms), validator), compute)
+
+
+def _validator(parms):
+    validators = response_validators(parms)
+    return validators[0] if validators else None
+
+
+def _precompute(parms):
+    validator = _validator(parms)
+    if cache.has_response(parms, validator=validator):
+        return
+    if cache.get_expire() > 0:
+        cache.cached_response(parms, lambda: handle_request(parms, validator), validator=validator)
+    else:
+        single_flight.do((normalize_oai_args(parms), validator),
+                         lambda: cache.store_prefetched(parms, create_server().handleRequest(parms), validator))
+
+
+def precompute_next_page(parms, res):
+    '''Render the page following `res` in the background, if it has a
+    resumption token and isn't cached yet, with a bounded pool of
+    ``ckanext.oaipmh.precompute.workers`` threads (default 0, disabled).
+    The page is written into the response cache, or parked until requested
+    if the cache is disabled.
+    '''
+    max_workers = int(config.get('ckanext.oaipmh.precompute.workers', 0))
+    if max_workers <= 0:
+        return
+    match = RESUMPTION_TOKEN.search(res)
+    if not match:
+        return
+    next_parms = {'verb': parms['verb'], 'resumptionToken': unescape(match.group(1))}
+    if workers.get_executor('precompute', max_workers).try_submit(_precompute, next_parms) is None:
+        log.debug('Precompute pool is full, not precomputing %s', next_parms)
+
+
+def cached_page(parms, validator=None):
+    '''Return the response for the request arguments from the response
+    cache, or compute it. Only a computed page has its next page
+    precomputed, so that cache hits don't cause any rendering.
+
+    :param validator: ETag of the response, see :func:`response_validators`
+    '''
+    computed = []
+
+    def create():
+        computed.append(True)
+        return handle_request(parms, validator)
+    res = cache.cached_response(parms, create, validator=validator)
+    if computed:
+        precompute_next_page(parms, res)
+    return res
+
+
+def response_validators(parms):
+    '''Return the ETag and Last-Modified of the response for the request
+    arguments. The ETag is made of the arguments and the ids and
+    modification times of the datasets on the response page, selected by
+    the query the server serves the page with. Only a GetRecord response
+    has a Last-Modified, the modification time of its dataset: the latest
+    modification time on a list page doesn't change when a dataset leaves
+    the page.
+
+    :returns: tuple of ETag and Last-Modified or None, or None if the
+        response can not be validated
+    '''
+    verb = parms.get('verb')
+    if verb not in VALIDATED_VERBS:
+        return None
+    cursor = 0
+    try:
+        if parms.get('resumptionToken'):
+            args, cursor = oaisrv.decodeResumptionToken(parms['resumptionToken'])
+        else:
+            args = {'set': parms.get('set')}
+            if parms.get('from'):
+                args['from_'] = datestamp_to_datetime(parms['from'])
+            if parms.get('until'):
+                args['until'] = datestamp_to_datetime(parms['until'], inclusive=True)
+    except Exception:
+        # Let the server report invalid arguments
+        return None
+    identifier = parms.get('identifier') if verb == 'GetRecord' else None
+    # The batching server fetches one record more than a page to see if
+    # there is a next page
+    state = CKANServer().last_modified(identifier=identifier, set=args.get('set'),
+                                       from_=args.get('from_'), until=args.get('until'),
+                                       cursor=cursor, batch_size=RESUMPTION_BATCH_SIZE + 1)
+    if state is None:
+        return None
+    modified, fingerprint = state
+    etag = hashlib.sha1(repr((normalize_oai_args(parms), modified.isoformat(), fingerprint)).encode('utf-8')).hexdigest()
+    return etag, modified if identifier else None
+
+
+def content_coding():
+    '''Return the content coding for the response, 'gzip' or 'deflate' if
+    the client accepts it explicitly and it is enabled in
+    ``ckanext.oaipmh.compression``, otherwise None.
+    '''
+    codings = get_compression()
+    # Without the header WebOb accepts any coding, but clients that don't
+    # ask for compression, e.g. pyoai's own client, can't decode it
+    if not codings or not request.headers.get('Accept-Encoding'):
+        return None
+    accepted = [coding for coding in codings if coding in request.accept_encoding]
+    return request.accept_encoding.best_match(accepted) if accepted else None
+
+
+def not_modified(etag, last_modified=None):
+    '''Check the conditional headers of the request against the response
+    validators. If-Modified-Since is only checked for a response with a
+    Last-Modified.
+    '''
+    if request.headers.get('If-None-Match'):
+        return etag in request.if_none_match
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0, tzinfo=UTC) <= request.if_modified_since
+    return False
+
 
 class OAIPMHController(BaseController):
     '''Controller for OAI-PMH server implementation. Returns only the index
@@ -24,18 +191,29 @@ class OAIPMHController(BaseController):
         if 'verb' in request.params:
             verb = request.params['verb'] if request.params['verb'] else None
             if verb:
-                client = CKANServer()
-                metadata_registry = oaimd.MetadataRegistry()
-                metadata_registry.registerReader('oai_dc', oaimd.oai_dc_reader)
-                metadata_registry.registerWriter('oai_dc', oaisrv.oai_dc_writer)
-                metadata_registry.registerReader('rdf', rdf_reader)
-                metadata_registry.registerWriter('rdf', dcat2rdf_writer)
-                serv = oaisrv.BatchingServer(client,
-                                             metadata_registry=metadata_registry,
-                                             resumption_batch_size=10)
                 parms = request.params.mixed()
-                res = serv.handleRequest(parms)
+                coding = content_coding()
+                response.headers['Vary'] = 'Accept-Encoding'
+                validators = response_validators(parms)
+                etag = None
+                if validators:
+                    etag, last_modified = validators
+                    coded_etag = '%s-%s' % (etag, coding) if coding else etag
+                    response.etag = coded_etag
+                    if last_modified:
+                        response.last_modified = last_modified
+                    if not_modified(coded_etag, last_modified):
+                        response.status_int = 304
+                        return ''
+                # The cached response is keyed by the ETag, so that it's never
+                # older than the validators sent with it. A page rendered from
+                # a newer state than its ETag only costs a full response later.
+                res = cached_page(parms, etag)
                 response.headers['content-type'] = 'text/xml; charset=utf-8'
+                if coding:
+                    res = cache.cached_response(parms, lambda: b''.join(compress([res], coding)),
+                                                variant=coding, validator=etag)
+                    response.headers['Content-Encoding'] = coding
                 return res
         else:
             return render('ckanext/oaipmh/oaipmh.html')
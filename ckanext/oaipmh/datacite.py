@@ -3,7 +3,7 @@ import logging
 import oaipmh
 
 from ckan import model
-from ckanext.oaipmh.harvester import OAIPMHHarvester
+from ckanext.oaipmh.harvester import OAIPMHHarvester, content_hash
 
 log = logging.getLogger(__name__)
 
@@ -57,6 +57,10 @@ class DataCiteHarvester(OAIPMHHarvester):
 
             return False
 
+        record_hash = content_hash(harvest_object.content)
+        if self._unchanged(harvest_object, record_hash):
+            return True
+
         content = json.loads(harvest_object.content)
 
 
@@ -67,7 +71,8 @@ class DataCiteHarvester(OAIPMHHarvester):
             if package and package.owner_org:
                 package_dict['owner_org'] = package.owner_org
 
-            schema = self.get_schema()
+            schema = self.harvest_context(harvest_object).schema('create', self.get_schema)
+            self._defer_indexing(harvest_object)
             result = self._create_or_update_package(package_dict,
                                                     harvest_object,
                                                     schema=schema,
@@ -80,4 +85,7 @@ class DataCiteHarvester(OAIPMHHarvester):
                 id=harvest_object.id, e=e), harvest_object)
             return False
 
+        if result:
+            self._package_written(harvest_object)
+            self._save_harvested_record(harvest_object, record_hash)
         return result
@@ -0,0 +1,129 @@
+'''Concurrent fetching of the records of a harvest job.
+
+Records are fetched with GetRecord by a thread pool. The requests in
+flight to each remote host are capped by an :class:`AdaptiveLimiter`,
+which raises the cap while the host keeps up and halves it on errors and
+latency spikes. Results are written to the database by the calling thread
+in batches.
+'''
+import logging
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from ckan.model import Session
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter(object):
+    '''Limit the concurrent requests to a host with additive increase and
+    multiplicative decrease of the limit.
+
+    :param max_limit: upper bound of concurrent requests
+    :param initial: limit to start with, defaults to half of `max_limit`
+    :param slowdown: latency, relative to the moving average, that is
+        treated like an error
+    '''
+
+    def __init__(self, max_limit, initial=None, slowdown=2.0):
+        self.max_limit = max_limit
+        self.limit = initial or max(1, max_limit // 2)
+        self.slowdown = slowdown
+        self.in_flight = 0
+        self.latency = None
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, error=False):
+        '''Release a slot and adjust the limit to the outcome of the request.
+
+        :param latency: duration of the request in seconds
+        :param error: whether the request failed
+        '''
+        with self._condition:
+            self.in_flight -= 1
+            if error or (self.latency is not None and latency > self.slowdown * self.latency):
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            if not error:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self._condition.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host, max_limit):
+    '''Return the process wide limiter of a host.
+
+    :rtype: AdaptiveLimiter
+    '''
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = AdaptiveLimiter(max_limit)
+        limiter.max_limit = max_limit
+        limiter.limit = min(limiter.limit, max_limit)
+        return limiter
+
+
+def fetch_objects(harvester, harvest_objects, url, registry, max_per_host, batch_size=100):
+    '''Fetch the records of harvest objects concurrently and store them in
+    the objects. Objects that can't be fetched are left without content
+    for the fetch stage.
+
+    :param harvester: the OAIPMHHarvester of the job
+    :param harvest_objects: HarvestObjects to fetch
+    :param url: OAI-PMH base URL of the source
+    :param registry: metadata registry for the clients
+    :param max_per_host: maximum number of requests in flight to the host
+    :param batch_size: number of objects written per commit
+    :returns: the number of objects stored
+    '''
+    limiter = get_limiter(urllib.parse.urlsplit(url).netloc, max_per_host)
+    local = threading.local()
+
+    def fetch(identifier):
+        if not hasattr(local, 'client'):
+            local.client = harvester.create_client(url, registry)
+        limiter.acquire()
+        start = time.time()
+        try:
+            header, metadata, _about = local.client.getRecord(identifier=identifier,
+                                                              metadataPrefix=harvester.md_format)
+        except Exception as e:
+            limiter.release(time.time() - start, error=True)
+            return None, None, e
+        limiter.release(time.time() - start)
+        return header, metadata, None
+
+    stored = 0
+    with ThreadPoolExecutor(max_workers=max_per_host) as executor:
+        futures = [(harvest_object, executor.submit(fetch, harvest_object.guid))
+                   for harvest_object in harvest_objects]
+        for count, (harvest_object, future) in enumerate(futures, 1):
+            header, metadata, error = future.result()
+            if error is not None:
+                log.info('Concurrent fetch: unable to get %s, leaving it to the fetch stage: %s',
+                         harvest_object.guid, error)
+            elif harvester._store_record(harvest_object, header, metadata, commit=False):
+                stored += 1
+            if count % batch_size == 0:
+                Session.commit()
+    Session.commit()
+    log.debug('Concurrent fetch: stored %d of %d objects, limit %d', stored, len(futures), limiter.limit)
+    return stored
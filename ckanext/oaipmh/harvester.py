@@ -2,8 +2,13 @@
 # vi:et:ts=8:
 import http.client 
 
+import copy
+import datetime
+import hashlib
 import logging
 import json
+import threading
+from collections import OrderedDict
 from itertools import islice
 from lxml import etree
 import urllib.request,urllib.parse,urllib.error
@@ -13,19 +18,30 @@ from paste.deploy.converters import asbool
 
 import oaipmh.client
 import oaipmh.error
+from oaipmh.datestamp import datetime_to_datestamp
 from dateutil.parser import parse as dp
 
 from ckanext.oaipmh.oai_dc_reader import dc_metadata_reader
 from ckanext.oaipmh.cmdi_reader import CmdiReader
 from ckanext.oaipmh.datacite_reader import DataCiteReader
 from ckanext.oaipmh.importformats import nrd_metadata_reader,xml_reader,rdf_reader
+from ckanext.oaipmh import checkpoint
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh.model import HarvestedRecord, SetWatermark
+from ckanext.oaipmh.fetcher import fetch_objects
+from ckanext.oaipmh.indexing import DeferredIndexing
+from ckanext.oaipmh.partitions import date_windows, list_partitions
+from ckanext.oaipmh import pids, policy
+from ckanext.oaipmh.transport import HTTPTransport, TransportClient
 
 from ckan.model import Session, Package
 from ckan.logic import NotFound, NotAuthorized, ValidationError
 from ckan import model
 
-from ckanext.harvest.model import HarvestJob, HarvestObject
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectExtra
 from ckanext.harvest.harvesters.base import HarvesterBase
+from ckanext.kata.utils import get_primary_pid
+from ckan.plugins import implements, IConfigurable
 
 from iso639 import languages
 
@@ -39,43 +55,38 @@ log = logging.getLogger(__name__)
 def get_package_id_by_primary_pid(data_dict):
     '''
     Try if the provided primary PID matches exactly one dataset.
-    THIS METHOD WAS PREVIOUSLY GET_PACKAGE_ID_BY_DATA_PIDS, is the below correct, or should relation pids also be used?
     :param data_dict:
     :return: Package id or None if not found.
     '''
     primary_pid = get_primary_pid(data_dict)
     if not primary_pid:
         return None
+    return pids.get_package_id_by_primary_pid(primary_pid)
 
-    pid_list = [primary_pid]
+# Number of identifiers reconciled and turned into harvest objects at a time
+GATHER_CHUNK_SIZE = 1000
+# Number of harvest objects whose existing packages are resolved at a time by a batch import
+IMPORT_CHUNK_SIZE = 100
 
-    # Get package ID's with matching PIDS
-    query = Session.query(model.PackageExtra.package_id.distinct()).\
-        filter(model.PackageExtra.value.in_(pid_list))
-    pkg_ids = query.all()
-    if len(pkg_ids) != 1:
-        return None              # Nothing to do if we get many or zero datasets
 
-    # Get extras with the received package ID's
-    query = select(['key', 'value', 'state']).where(
-        and_(model.PackageExtra.package_id.in_(pkg_ids), model.PackageExtra.key.like('pids_%')))
-
-    extras = Session.execute(query)
-
-    # Dictize the results
-    extras = model_dictize.extras_list_dictize(extras, {'model': PackageExtra})
-
-    # Check that matching PIDS are type 'primary'.
-    for extra in extras:
-        key = extra['key'].split('_')   # eg. ['pids', '0', 'id']
-
-        if key[2] == 'id' and extra['value'] in pid_list:
-            type_key = '_'.join(key[:2] + ['type'])
-
-            if not filter(lambda x: x['key'] == type_key and (x['value'] == 'primary'), extras):
-                return None      # Found a hit with wrong type of PID
-
-    return pkg_ids[0]    # No problems found, so use this
+def chunks(iterable, size):
+    '''
+    Split an iterable into lists of at most `size` items.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def content_hash(content):
+    '''
+    Return a hash of the JSON content of a harvest object which doesn't
+    depend on the order of keys.
+    '''
+    normalized = json.dumps(json.loads(content), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
 
 def pid_to_name(string):
     '''
@@ -107,13 +118,111 @@ def create_metadata_registry(harvest_type=None, service_url=None):
     registry.registerReader('xml', xml_reader)
     return registry
 
+class HarvestContext(object):
+    '''
+    Parsed configuration, metadata registry, client, package schemas and
+    deferred search indexing of a harvest job, shared by the stages of all
+    its objects.
+    '''
+
+    def __init__(self, harvester, url, config, registry):
+        self.harvester = harvester
+        self.url = url
+        self.config = config
+        self.registry = registry
+        self.indexing = None
+        self._client = None
+        self._schemas = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.harvester.create_client(self.url, self.registry)
+        return self._client
+
+    def schema(self, key, create):
+        '''
+        Return a copy of the package schema cached under `key`, created with
+        `create` on first use. Copies are returned as validation may modify
+        the schema.
+        '''
+        if key not in self._schemas:
+            self._schemas[key] = create()
+        return copy.deepcopy(self._schemas[key])
+
+    def end_indexing(self):
+        '''
+        Index the packages whose indexing was deferred, and turn the
+        automatic indexing back on.
+        '''
+        indexing, self.indexing = self.indexing, None
+        if indexing is not None:
+            indexing.__exit__(None, None, None)
+
+
 class OAIPMHHarvester(HarvesterBase):
     '''
     OAI-PMH Harvester
     '''
+    implements(IConfigurable)
+
     md_format = "oai_dc"
+    # Keep-alive connections shared by all harvest jobs and stages run in this process
+    transport = None
+    # Existing package ids by primary PID of the chunk being batch imported, or None
+    _batch_packages = None
+    # Ids of the packages written in the chunk being batch imported, indexed after the chunk
+    _batch_written = None
+    # Contexts of the most recently harvested jobs, by harvester, job and source configuration
+    contexts = OrderedDict()
+    contexts_lock = threading.Lock()
+    max_contexts = 16
+
+    def create_client(self, url, registry):
+        ''' Return an OAI-PMH client for `url` using the pooled HTTP transport
+            of this process and the request policy of the source.
+        '''
+        if OAIPMHHarvester.transport is None:
+            OAIPMHHarvester.transport = HTTPTransport(timeout=int(c.get('ckanext.oaipmh.harvest.timeout', 60)))
+        request_policy = policy.get_policy(
+            url,
+            retries=int(c.get('ckanext.oaipmh.harvest.retries', 4)),
+            backoff=float(c.get('ckanext.oaipmh.harvest.backoff', 1)),
+            max_backoff=float(c.get('ckanext.oaipmh.harvest.max_backoff', 60)),
+            failure_threshold=int(c.get('ckanext.oaipmh.harvest.failure_threshold', 5)),
+            cooldown=float(c.get('ckanext.oaipmh.harvest.cooldown', 30)),
+            max_cooldown=float(c.get('ckanext.oaipmh.harvest.max_cooldown', 600)))
+        return TransportClient(url, registry, transport=OAIPMHHarvester.transport, policy=request_policy)
+
+    def configure(self, config):
+        pids.setup()
+
+    def harvest_context(self, harvest_job):
+        ''' Return the HarvestContext of a harvest job, or of the job of a
+            harvest object. A new context is made for every job, and when
+            the configuration of the source changes.
+        '''
+        source = harvest_job.source
+        job = getattr(harvest_job, 'job', harvest_job)
+        key = (type(self), job.id, source.url, source.config)
+        with OAIPMHHarvester.contexts_lock:
+            context = self.contexts.pop(key, None)
+            if context is None:
+                config = self._parse_configuration(harvest_job)
+                context = HarvestContext(self, source.url, config, self.metadata_registry(config, harvest_job))
+            self.contexts[key] = context
+            while len(self.contexts) > self.max_contexts:
+                _key, evicted = self.contexts.popitem(last=False)
+                evicted.end_indexing()
+        return context
 
     def _get_configuration(self, harvest_job):
+        """ Return the configuration of the source of a harvest job or
+            object. The returned dictionary may be modified.
+        """
+        return dict(self.harvest_context(harvest_job).config)
+
+    def _parse_configuration(self, harvest_job):
         """ Parse configuration from given harvest object """
         configuration = {}
         if harvest_job.source.config:
@@ -212,6 +321,12 @@ class OAIPMHHarvester(HarvesterBase):
             validate_param(dj, 'set', list)
             validate_param(dj, 'limit', int)
             validate_param(dj, 'type', basestring)
+            validate_param(dj, 'bulk', bool)
+            validate_param(dj, 'defer_indexing', bool)
+            validate_param(dj, 'fetch_workers', int)
+            validate_param(dj, 'force_update', bool)
+            validate_param(dj, 'gather_workers', int)
+            validate_param(dj, 'gather_window_days', int)
             validate_date_param(dj, 'until', basestring)
             validate_date_param(dj, 'from', basestring)
         else:
@@ -241,8 +356,9 @@ class OAIPMHHarvester(HarvesterBase):
     #     :returns: A string with the URL to the original document
     #     '''
 
-    def get_package_ids(self, set_ids, config, last_time, client):
-        ''' Get package identifiers from given set identifiers.
+    def _list_kwargs(self, config):
+        ''' Build the arguments of ListIdentifiers/ListRecords requests from
+            the source configuration.
         '''
         def filter_map_args(list_tuple):
             for key, value in list_tuple:
@@ -253,22 +369,202 @@ class OAIPMHHarvester(HarvesterBase):
 
         kwargs = dict(filter_map_args(config.items()))
         kwargs['metadataPrefix'] = self.md_format
-        if last_time and 'from_' not in kwargs:
-            kwargs['from_'] = dp(last_time).replace(tzinfo=None)
-        if set_ids:
-            for set_id in set_ids:
-                try:
-                    for header in client.listIdentifiers(set=set_id, **kwargs):
-                        yield header.identifier()
-                except oaipmh.error.NoRecordsMatchError:
-                    pass
+        return kwargs
+
+    @staticmethod
+    def _set_kwargs(kwargs, set_id, watermarks):
+        ''' Return the list arguments of a set, starting from the watermark of
+            the set unless `from` is configured.
+        '''
+        set_kwargs = dict(kwargs, set=set_id) if set_id else dict(kwargs)
+        watermark = (watermarks or {}).get(set_id or u'')
+        if watermark and 'from_' not in kwargs:
+            set_kwargs['from_'] = watermark
+        return set_kwargs
+
+    @staticmethod
+    def _update_latest(latest, set_spec, datestamp):
+        ''' Keep the latest datestamp seen in each set. '''
+        if latest is not None and datestamp and (set_spec not in latest or datestamp > latest[set_spec]):
+            latest[set_spec] = datestamp
+
+    def _list(self, list_method, set_ids, kwargs, watermarks=None):
+        ''' Page through a list verb for each set, or the whole repository.
+            Yields each item with its set spec, '' for the whole repository.
+        '''
+        for set_id in set_ids or [None]:
+            try:
+                for item in list_method(**self._set_kwargs(kwargs, set_id, watermarks)):
+                    yield set_id or u'', item
+            except oaipmh.error.NoRecordsMatchError:
+                pass
+
+    def get_package_ids(self, set_ids, config, watermarks, client, harvest_job=None):
+        ''' Get package identifiers from given set identifiers.
+            With a harvest job and an OAI-PMH client, the walk is
+            checkpointed after every page and resumes from the checkpoint
+            of an interrupted gather.
+
+            :param watermarks: dict of the datestamps to harvest each set
+                spec from, '' for the whole repository, or None
+        '''
+        for identifier, _datestamp in self.get_headers(set_ids, config, watermarks, client, harvest_job):
+            yield identifier
+
+    def get_headers(self, set_ids, config, watermarks, client, harvest_job=None, latest=None):
+        ''' Get the identifiers and datestamps of records from given set
+            identifiers, see :meth:`get_package_ids`.
+
+            :param latest: dict to update with the latest datestamp seen in
+                each set
+        '''
+        kwargs = self._list_kwargs(config)
+        if harvest_job is not None and isinstance(client, oaipmh.client.BaseClient) and config.get('gather_workers'):
+            for item in self._partitioned_headers(harvest_job, set_ids, config, kwargs, watermarks, client, latest):
+                yield item
+            return
+        if harvest_job is not None and isinstance(client, oaipmh.client.BaseClient):
+            for item in self._checkpointed_headers(harvest_job, set_ids, kwargs, watermarks, client, latest):
+                yield item
+            return
+        for set_spec, header in self._list(client.listIdentifiers, set_ids, kwargs, watermarks):
+            self._update_latest(latest, set_spec, header.datestamp())
+            yield header.identifier(), header.datestamp()
+
+    def _partitioned_headers(self, harvest_job, set_ids, config, kwargs, watermarks, client, latest=None):
+        ''' List the sets concurrently with at most `gather_workers` (source
+            config) requests in flight. With `gather_window_days`, each set
+            is split further into windows of that many days from its `from`,
+            or the earliest datestamp of the source. The walk isn't
+            checkpointed.
+        '''
+        identify = client.identify()
+        day_granularity = identify.granularity() == 'YYYY-MM-DD'
+        partitions = []
+        for set_id in set_ids or [None]:
+            set_spec = set_id or u''
+            set_kwargs = self._set_kwargs(kwargs, set_id, watermarks)
+            if not config.get('gather_window_days'):
+                partitions.append((set_spec, set_kwargs))
+                continue
+            start = set_kwargs.get('from_') or identify.earliestDatestamp()
+            for from_, until in date_windows(start, config['gather_window_days'], day_granularity,
+                                             set_kwargs.get('until')):
+                window_kwargs = dict(set_kwargs, from_=from_)
+                if until:
+                    window_kwargs['until'] = until
+                partitions.append((set_spec, window_kwargs))
+        log.info('Gathering %d partitions of %s with %d workers', len(partitions),
+                 harvest_job.source.url, config['gather_workers'])
+
+        for set_spec, identifier, datestamp in list_partitions(
+                self, partitions, harvest_job.source.url, self.metadata_registry(config, harvest_job),
+                config['gather_workers'], day_granularity):
+            self._update_latest(latest, set_spec, datestamp)
+            yield identifier, datestamp
+
+    def _identifier_pages(self, client, set_id, kwargs, token=None):
+        ''' Yield the headers and the resumption token of each ListIdentifiers
+            page, starting after `token` if given.
+        '''
+        namespaces = client.getNamespaces()
+        if token:
+            tree = client.makeRequestErrorHandling(verb='ListIdentifiers', resumptionToken=token)
+        else:
+            args = {'metadataPrefix': kwargs['metadataPrefix']}
+            if set_id:
+                args['set'] = set_id
+            for key, name in (('from_', 'from'), ('until', 'until')):
+                if kwargs.get(key):
+                    args[name] = datetime_to_datestamp(kwargs[key], getattr(client, '_day_granularity', False))
+            tree = client.makeRequestErrorHandling(verb='ListIdentifiers', **args)
+        while True:
+            headers, token = client.buildIdentifiers(namespaces, tree)
+            yield headers, token
+            if not token:
+                return
+            tree = client.makeRequestErrorHandling(verb='ListIdentifiers', resumptionToken=token)
+
+    def _checkpointed_headers(self, harvest_job, set_ids, kwargs, watermarks, client, latest=None):
+        ''' Walk ListIdentifiers set by set, saving a checkpoint after every
+            page, and continue from the checkpoint of an interrupted walk.
+            Identifiers may repeat when a set is walked again.
+
+            On resume the identifiers gathered before the checkpoint are
+            yielded again for this job, and the objects the interrupted job
+            left waiting are marked as errors, so that no record is imported
+            twice.
+        '''
+        harvest_source_id = harvest_job.source.id
+        latest = {} if latest is None else latest
+        params = checkpoint.walk_params(set_ids, dict(kwargs, watermarks=sorted(
+            (set_spec, datestamp.isoformat()) for set_spec, datestamp in (watermarks or {}).items())))
+        state = checkpoint.load(harvest_source_id, params)
+        if state:
+            log.info('Resuming gather of %s from set "%s"', harvest_source_id, state.set_spec or '')
+            latest.update(checkpoint.watermarks(state))
+            self._abandon_objects(harvest_job)
+            for item in checkpoint.headers(harvest_source_id):
+                yield item
         else:
+            state = checkpoint.start(harvest_source_id, params)
+
+        completed = checkpoint.completed_sets(state)
+        for set_id in sorted(set_ids) if set_ids else [None]:
+            set_spec = set_id or u''
+            if set_spec in completed:
+                continue
+            token = state.resumption_token if state.set_spec == set_spec else None
+            set_kwargs = self._set_kwargs(kwargs, set_id, watermarks)
+
+            def walk(token):
+                for headers, next_token in self._identifier_pages(client, set_id, set_kwargs, token):
+                    page = [(header.identifier(), header.datestamp()) for header in headers]
+                    for _identifier, datestamp in page:
+                        self._update_latest(latest, set_spec, datestamp)
+                    checkpoint.save_page(state, set_spec, next_token, page, latest)
+                    for item in page:
+                        yield item
+
             try:
-                for header in client.listIdentifiers(**kwargs):
-                    yield header.identifier()
+                try:
+                    for item in walk(token):
+                        yield item
+                except oaipmh.error.BadResumptionTokenError:
+                    if not token:
+                        raise
+                    log.info('Resumption token of set "%s" has expired, walking the set again', set_spec)
+                    for item in walk(None):
+                        yield item
             except oaipmh.error.NoRecordsMatchError:
                 pass
-                # package_ids = [header.identifier() for header in client.listRecords()]
+            checkpoint.complete_set(state, set_spec)
+
+    @staticmethod
+    def _abandon_objects(harvest_job):
+        ''' Mark the waiting objects of the interrupted gathers of the source
+            of a job as errors. They were never queued for fetching.
+        '''
+        interrupted = Session.query(HarvestJob.id). \
+            filter(HarvestJob.source_id == harvest_job.source.id). \
+            filter(HarvestJob.gather_finished == None). \
+            filter(HarvestJob.id != harvest_job.id)
+        count = Session.query(HarvestObject). \
+            filter(HarvestObject.harvest_job_id.in_(interrupted.subquery())). \
+            filter(HarvestObject.state == 'WAITING'). \
+            update({'state': 'ERROR'}, synchronize_session=False)
+        Session.commit()
+        if count:
+            log.info('Marked %d objects of interrupted gathers of %s as errors', count, harvest_job.source.id)
+
+    def get_records(self, set_ids, config, watermarks, client, latest=None):
+        ''' Get the headers and metadata of records from given set
+            identifiers with ListRecords, see :meth:`get_headers`.
+        '''
+        kwargs = self._list_kwargs(config)
+        for set_spec, (header, metadata, _about) in self._list(client.listRecords, set_ids, kwargs, watermarks):
+            self._update_latest(latest, set_spec, header.datestamp())
+            yield header, metadata
 
     def gather_stage(self, harvest_job):
         '''
@@ -295,7 +591,7 @@ class OAIPMHHarvester(HarvesterBase):
 
         # Create a OAI-PMH Client
         registry = self.metadata_registry(config, harvest_job)
-        client = oaipmh.client.Client(harvest_job.source.url, registry)
+        client = self.create_client(harvest_job.source.url, registry)
 
         available_sets = list(client.listSets())
 
@@ -330,43 +626,63 @@ class OAIPMHHarvester(HarvesterBase):
             .order_by(HarvestJob.gather_finished.desc()) \
             .limit(1).first()
 
-        last_time = None
-        if previous_job and previous_job.finished and model.Package.get(harvest_job.source.id).metadata_modified < previous_job.gather_started:
-            last_time = previous_job.gather_started.isoformat()
-
-        # Collect package ids
-        package_ids = list(self.get_package_ids(set_ids, config, last_time, client))
-        log.debug('Identifiers: %s', package_ids)
-
-        if not self._recreate(harvest_job) and package_ids:
-            converted_identifiers = {}
-            for identifier in package_ids:
-                converted_identifiers[pid_to_name(identifier)] = identifier
-                if identifier.endswith(u'm'):
-                    converted_identifiers[pid_to_name(u"%ss" % identifier[0:-1])] = identifier
-
-            for package in model.Session.query(model.Package).filter(model.Package.name.in_(converted_identifiers.keys())).all():
-                converted_name = package.name
-                if converted_identifiers[converted_name] not in package_ids:
-                    converted_name = "%sm" % converted_name[0:-1]
-                package_ids.remove(converted_identifiers[converted_name])
-
-        if previous_job:
-            for previous_error in [error.guid for error in Session.query(HarvestObject).
-                                   filter(HarvestObject.harvest_job_id == previous_job.id).
-                                   filter(HarvestObject.state == 'ERROR').all()]:
-                if previous_error not in package_ids:
-                    package_ids.append(previous_error)
+        recreate = self._recreate(harvest_job)
+        force_update = config.get('force_update')
+
+        # Continue each set from the latest datestamp of the previous harvest,
+        # unless the source has been changed since
+        watermarks = None
+        if previous_job and previous_job.finished and not force_update and \
+                model.Package.get(harvest_job.source.id).metadata_modified < previous_job.gather_started:
+            watermarks = self._watermarks(harvest_job.source.id, client)
+        latest = {}
+
+        # Digests of the identifiers taken so far
+        seen = set()
+
+        def candidates():
+            gathered = self._unique(self._gathered(set_ids, config, watermarks, client, harvest_job, latest), seen)
+            for chunk in chunks(gathered, GATHER_CHUNK_SIZE):
+                if not force_update:
+                    chunk = self._changed(harvest_job.source.id, chunk)
+                for item in chunk if recreate else self._without_existing(chunk):
+                    yield item
+            if previous_job:
+                errors = Session.query(HarvestObject.guid). \
+                    filter(HarvestObject.harvest_job_id == previous_job.id). \
+                    filter(HarvestObject.state == 'ERROR').all()
+                for item in self._unique(((guid, None, None) for guid, in errors), seen):
+                    yield item
 
         try:
             object_ids = []
-            if len(package_ids):
-                for package_id in islice(package_ids, config['limit']) if 'limit' in config else package_ids:
-                    # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid=package_id, job=harvest_job)
-                    obj.save()
-                    object_ids.append(obj.id)
-                log.debug('Object ids: {i}'.format(i=object_ids))
+            items = candidates()
+            if 'limit' in config:
+                items = islice(items, config['limit'])
+            for chunk in chunks(items, GATHER_CHUNK_SIZE):
+                objects = self._create_objects(harvest_job, chunk)
+                unfetched = []
+                for obj, (_package_id, _datestamp, record) in zip(objects, chunk):
+                    if record:
+                        self._store_record(obj, *record, commit=False)
+                    elif config.get('fetch_workers'):
+                        unfetched.append(obj)
+                Session.flush()
+                object_ids.extend(obj.id for obj in objects)
+                Session.commit()
+                if unfetched:
+                    self.fetch_concurrently(harvest_job, config, unfetched)
+            if 'limit' not in config:
+                # With a limit, the records after it haven't been harvested
+                self._save_watermarks(harvest_job.source.id, latest)
+            checkpoint.clear(harvest_job.source.id)
+            if object_ids:
+                log.debug('Gathered %d objects', len(object_ids))
+                if config.get('batch_import'):
+                    # The objects stay WAITING, and the job unfinished, until
+                    # the batch import has fetched and imported them
+                    log.info('Leaving %d objects of job %s to a batch import', len(object_ids), harvest_job.id)
+                    return []
                 return object_ids
             else:
                 self._save_gather_error('No packages received for URL: {u}'.format(
@@ -376,6 +692,148 @@ class OAIPMHHarvester(HarvesterBase):
             self._save_gather_error('Gather: {e}'.format(e=e), harvest_job)
             raise
 
+    @staticmethod
+    def _create_objects(harvest_job, chunk):
+        ''' Create HarvestObjects for a chunk of gathered items. The remote
+            datestamp of a record is kept in the `datestamp` extra of its
+            object. The objects are inserted together on the next flush
+            instead of with a commit each.
+
+            :returns: the objects in the order of `chunk`
+        '''
+        objects = []
+        for guid, datestamp, _record in chunk:
+            extras = [HarvestObjectExtra(key='datestamp', value=datestamp.isoformat())] if datestamp else []
+            objects.append(HarvestObject(guid=guid, job=harvest_job, extras=extras))
+        Session.add_all(objects)
+        return objects
+
+    @staticmethod
+    def _watermarks(harvest_source_id, client):
+        ''' Return the watermarks of the sets of a source, or None. The
+            client is set to the granularity of the source, so that a
+            watermark is sent as the day it's on for sources with day
+            granularity.
+        '''
+        watermarks = dict(Session.query(SetWatermark.set_spec, SetWatermark.datestamp).
+                          filter(SetWatermark.harvest_source_id == harvest_source_id))
+        if not watermarks:
+            return None
+        if hasattr(client, 'updateGranularity'):
+            try:
+                client.updateGranularity()
+            except Exception as e:
+                log.warning('Unable to get the granularity of %s, harvesting all records: %s',
+                            harvest_source_id, e)
+                return None
+        return watermarks
+
+    @staticmethod
+    def _save_watermarks(harvest_source_id, latest):
+        ''' Advance the watermarks of the sets of a source to the latest
+            datestamps of a finished gather.
+        '''
+        for set_spec, datestamp in latest.items():
+            watermark = SetWatermark.get(harvest_source_id, set_spec)
+            if watermark is None:
+                watermark = SetWatermark(harvest_source_id=harvest_source_id, set_spec=set_spec, datestamp=datestamp)
+            elif datestamp > watermark.datestamp:
+                watermark.datestamp = datestamp
+            watermark.add()
+        Session.commit()
+
+    def _gathered(self, set_ids, config, watermarks, client, harvest_job, latest=None):
+        ''' Yield the gathered identifiers with their datestamps and records,
+            which are received already in the gather stage with bulk fetch,
+            or None.
+        '''
+        if config.get('bulk'):
+            for header, metadata in self.get_records(set_ids, config, watermarks, client, latest):
+                yield header.identifier(), header.datestamp(), (header, metadata)
+        else:
+            for identifier, datestamp in self.get_headers(set_ids, config, watermarks, client, harvest_job, latest):
+                yield identifier, datestamp, None
+
+    @staticmethod
+    def _unique(items, seen):
+        ''' Drop items whose identifier has been seen. Identifiers are kept
+            in `seen` as 16 byte digests, which are smaller than most
+            identifiers.
+        '''
+        for item in items:
+            digest = hashlib.md5(item[0].encode('utf-8')).digest()
+            if digest not in seen:
+                seen.add(digest)
+                yield item
+
+    @staticmethod
+    def _changed(harvest_source_id, chunk):
+        ''' Drop the items of a chunk whose remote datestamp isn't newer than
+            the datestamp of the imported record, if its package still
+            exists, with a single query.
+        '''
+        imported = dict(Session.query(HarvestedRecord.guid, HarvestedRecord.datestamp).
+                        join(model.Package, model.Package.id == HarvestedRecord.package_id).
+                        filter(model.Package.state == 'active').
+                        filter(HarvestedRecord.harvest_source_id == harvest_source_id).
+                        filter(HarvestedRecord.guid.in_([item[0] for item in chunk])))
+        changed = []
+        for item in chunk:
+            identifier, datestamp = item[:2]
+            if datestamp is None or imported.get(identifier) is None or datestamp > imported[identifier]:
+                changed.append(item)
+        log.debug('%d of %d records are new or changed', len(changed), len(chunk))
+        return changed
+
+    @staticmethod
+    def _without_existing(chunk):
+        ''' Drop the items of a chunk whose identifier already has a
+            package, with a single query.
+        '''
+        converted_identifiers = {}
+        for item in chunk:
+            identifier = item[0]
+            converted_identifiers[pid_to_name(identifier)] = identifier
+            if identifier.endswith(u'm'):
+                converted_identifiers[pid_to_name(u"%ss" % identifier[0:-1])] = identifier
+        existing = set(converted_identifiers[name] for name, in
+                       Session.query(model.Package.name).
+                       filter(model.Package.name.in_(list(converted_identifiers.keys()))))
+        return [item for item in chunk if item[0] not in existing]
+
+    def fetch_concurrently(self, harvest_job, config, harvest_objects):
+        ''' Fetch the records of the job concurrently, with at most
+            `fetch_workers` (source config) requests in flight to the host.
+            Objects not fetched here are fetched in the fetch stage.
+        '''
+        try:
+            fetch_objects(self, harvest_objects, harvest_job.source.url,
+                          self.metadata_registry(config, harvest_job), config['fetch_workers'])
+        except Exception:
+            log.exception('Concurrent fetch failed, leaving the objects to the fetch stage')
+            Session.rollback()
+
+    def _store_record(self, harvest_object, header, metadata, commit=True):
+        ''' Store a record received before the fetch stage (bulk or
+            concurrent fetch) in its HarvestObject. Records that can't be
+            stored are left for the fetch stage to get with GetRecord.
+
+            :returns: True if the record was stored
+        '''
+        if header.isDeleted():
+            return self.on_deleted(harvest_object, header)
+        try:
+            harvest_object.content = json.dumps(metadata.getMap())
+        except Exception as e:
+            log.warning('Unable to get content for %s, fetching it separately: %s',
+                        harvest_object.guid, e)
+            return False
+        if commit:
+            harvest_object.save()
+        else:
+            harvest_object.add()
+        return True
+
     def fetch_stage(self, harvest_object):
         '''
         The fetch stage will receive a HarvestObject object and will be
@@ -389,19 +847,24 @@ class OAIPMHHarvester(HarvesterBase):
         :returns: True if everything went right, False if errors were found
         '''
         log.debug("fetch: %s", harvest_object.guid)
+        if harvest_object.content or harvest_object.report_status == "deleted":
+            # Already received in the gather stage (bulk or concurrent fetch)
+            return True
+
         # Get metadata content from provider
         try:
-            # Create a OAI-PMH Client
-            config = self._get_configuration(harvest_object)
-
-            registry = self.metadata_registry(config, harvest_object)
-            client = oaipmh.client.Client(harvest_object.job.source.url, registry)
+            # OAI-PMH Client of the source
+            client = self.harvest_context(harvest_object).client
 
             # Get source URL
             header, metadata, _about = client.getRecord(identifier=harvest_object.guid, metadataPrefix=self.md_format)
         except Exception as e:
-            import traceback
-            traceback.print_exc()
+            if policy.is_transient(e):
+                # Already retried by the request policy, no need for a traceback
+                log.warning('Unable to get %s: %s', harvest_object.guid, e)
+            else:
+                import traceback
+                traceback.print_exc()
             self._save_object_error('Unable to get metadata from provider: {u}: {e}'.format(
                 u=harvest_object.source.url, e=e), harvest_object)
             return False
@@ -464,6 +927,10 @@ class OAIPMHHarvester(HarvesterBase):
 
             return False
 
+        record_hash = content_hash(harvest_object.content)
+        if self._unchanged(harvest_object, record_hash):
+            return True
+
         content = json.loads(harvest_object.content)
         # import pprint; pprint.pprint(content)
 
@@ -471,8 +938,8 @@ class OAIPMHHarvester(HarvesterBase):
         package_dict['xpaths'] = content
 
         # If package exists use old PID, otherwise create new
-        pkg_id = get_package_id_by_primary_pid(package_dict)
-        pkg = Session.query(Package).filter(Package.id == pkg_id).first() if pkg_id else None
+        pkg_id = self._existing_package_id(package_dict)
+        pkg = Package.get(pkg_id) if pkg_id else None
         log.debug('Package: "{pkg}"'.format(pkg=pkg))
 
         if pkg and not self._recreate(harvest_object):
@@ -488,7 +955,8 @@ class OAIPMHHarvester(HarvesterBase):
             if package and package.owner_org:
                 package_dict['owner_org'] = package.owner_org
 
-            config = self._get_configuration(harvest_object)
+            context = self.harvest_context(harvest_object)
+            config = context.config
             if config.get('type') == 'ida':
                 if package_dict.get('owner_org', False):
                     package_dict['private'] = "true"
@@ -496,7 +964,8 @@ class OAIPMHHarvester(HarvesterBase):
                 package_dict.pop('uploader')
             if config.get('type') == 'ida':
                 package_dict['persist_schema'] = u'True'
-            schema = self.get_schema(config, pkg)
+            schema = context.schema('update' if pkg else 'create', lambda: self.get_schema(config, pkg))
+            self._defer_indexing(harvest_object)
             # schema['xpaths'] = [ignore_missing, ckanext.kata.converters.xpath_to_extras]
             result = self._create_or_update_package(package_dict,
                                                     harvest_object,
@@ -534,8 +1003,187 @@ class OAIPMHHarvester(HarvesterBase):
                 id=harvest_object.id, e=e), harvest_object)
             return False
 
+        if result:
+            self._package_written(harvest_object)
+            self._save_harvested_record(harvest_object, record_hash)
         return result
 
+    def _defer_indexing(self, harvest_object):
+        ''' Turn off the automatic search indexing before the import stage
+            of a job with `defer_indexing` (source config) writes its first
+            package. The packages written are then indexed in batches, at
+            the latest `ckanext.oaipmh.harvest.index_delay` seconds after
+            they're written, and when the last object of the job has been
+            imported. A batch import defers the indexing of the whole job.
+        '''
+        if self._batch_written is not None:
+            return
+        context = self.harvest_context(harvest_object)
+        if context.config.get('defer_indexing') and context.indexing is None:
+            indexing = DeferredIndexing(max_delay=float(c.get('ckanext.oaipmh.harvest.index_delay', 10)))
+            context.indexing = indexing.__enter__()
+
+    def _package_written(self, harvest_object):
+        ''' Index the PIDs of a written package, and remember it for the
+            search indexing of a batch import. The deferred indexing of a
+            job ends with the import of its last object.
+        '''
+        pids.index_package(harvest_object.package_id)
+        if self._batch_written is not None:
+            self._batch_written.append(harvest_object.package_id)
+            return
+        context = self.harvest_context(harvest_object)
+        if context.indexing is not None and not self._job_unfinished(harvest_object):
+            context.end_indexing()
+
+    @staticmethod
+    def _job_unfinished(harvest_object):
+        ''' Check if the job of an object has other objects to import. '''
+        return Session.query(HarvestObject.id). \
+            filter(HarvestObject.harvest_job_id == harvest_object.job.id). \
+            filter(HarvestObject.state.in_(['WAITING', 'FETCH', 'IMPORT'])). \
+            filter(HarvestObject.id != harvest_object.id).first() is not None
+
+    def _existing_package_id(self, package_dict):
+        ''' Return the id of the package with the primary PID of the
+            package dict, resolved for the whole chunk in a batch import.
+        '''
+        if self._batch_packages is not None:
+            return self._batch_packages.get(get_primary_pid(package_dict))
+        return get_package_id_by_primary_pid(package_dict)
+
+    def import_objects(self, harvest_objects, chunk_size=IMPORT_CHUNK_SIZE, indexing=None):
+        ''' Import harvest objects left to a batch import in chunks. The
+            existing packages of a chunk are resolved with one query and
+            objects which weren't fetched in the gather stage are fetched
+            first. Each object is imported in a transaction of its own, as
+            the package actions commit, so that a failing object is rolled
+            back alone. The written packages aren't indexed one by one but
+            in batches, after their chunk is imported.
+
+            :param harvest_objects: HarvestObjects of a job in state WAITING
+            :param indexing: DeferredIndexing shared by several calls, e.g.
+                the whole job. By default the packages are indexed before
+                returning.
+            :returns: the number of objects imported successfully
+        '''
+        if indexing is None:
+            with DeferredIndexing() as indexing:
+                return self.import_objects(harvest_objects, chunk_size, indexing)
+
+        imported = 0
+        for chunk in chunks(harvest_objects, chunk_size):
+            chunk = [harvest_object for harvest_object in chunk if self._fetch_for_import(harvest_object)]
+            primary_pids = []
+            for harvest_object in chunk:
+                try:
+                    primary_pids.append(get_primary_pid(json.loads(harvest_object.content)['unified']))
+                except (TypeError, ValueError, KeyError):
+                    pass
+
+            self._batch_packages = pids.get_package_ids_by_primary_pids([pid for pid in primary_pids if pid])
+            self._batch_written = written = []
+            try:
+                for harvest_object in chunk:
+                    if self._import_object(harvest_object):
+                        imported += 1
+            finally:
+                self._batch_packages = None
+                self._batch_written = None
+            for package_id in written:
+                indexing.add(package_id)
+            log.debug('Batch import: %d objects imported', imported)
+        return imported
+
+    def _fetch_for_import(self, harvest_object):
+        ''' Fetch an object of a batch import which wasn't fetched in the
+            gather stage, like the fetch stage of ckanext-harvest does.
+
+            :returns: False if the fetch failed
+        '''
+        if harvest_object.content or harvest_object.report_status == 'deleted':
+            return True
+        harvest_object.fetch_started = datetime.datetime.now()
+        harvest_object.state = 'FETCH'
+        harvest_object.save()
+        fetched = self.fetch_stage(harvest_object)
+        harvest_object.fetch_finished = datetime.datetime.now()
+        if not fetched:
+            harvest_object.state = 'ERROR'
+        harvest_object.save()
+        return bool(fetched)
+
+    def _import_object(self, harvest_object):
+        ''' Import an object of a batch like the import stage of
+            ckanext-harvest does. An error rolls back the transaction of
+            the object.
+        '''
+        harvest_object.import_started = datetime.datetime.now()
+        harvest_object.state = 'IMPORT'
+        harvest_object.save()
+        try:
+            result = self.import_stage(harvest_object)
+        except Exception as e:
+            log.exception('Batch import of %s failed', harvest_object.guid)
+            Session.rollback()
+            self._save_object_error('Import: Could not create {id}. {e}'.format(
+                id=harvest_object.id, e=e), harvest_object)
+            result = False
+        harvest_object.state = 'COMPLETE' if result else 'ERROR'
+        harvest_object.import_finished = datetime.datetime.now()
+        harvest_object.save()
+        return bool(result)
+
+    def _unchanged(self, harvest_object, record_hash):
+        ''' Check if the record has been imported before with the same
+            content and its package still exists. If so, the harvest object
+            is made the current object of the package, so that the import
+            can be skipped. Configuration parameter `force_update` disables
+            the check, and the check of datestamps in the gather stage.
+        '''
+        if self._get_configuration(harvest_object).get('force_update'):
+            return False
+        record = HarvestedRecord.get(harvest_object.harvest_source_id, harvest_object.guid)
+        if not record or record.content_hash != record_hash:
+            return False
+        package = model.Package.get(record.package_id)
+        if not package or package.state != 'active':
+            return False
+        record.datestamp = self._remote_datestamp(harvest_object)
+        record.add()
+
+        for previous in Session.query(HarvestObject). \
+                filter(HarvestObject.package_id == package.id). \
+                filter(HarvestObject.current == True). \
+                filter(HarvestObject.id != harvest_object.id):
+            previous.current = False
+        harvest_object.package_id = package.id
+        harvest_object.current = True
+        harvest_object.save()
+        log.debug('Unchanged record %s, skipping import', harvest_object.guid)
+        return True
+
+    @staticmethod
+    def _remote_datestamp(harvest_object):
+        ''' Return the remote datestamp of the record of a harvest object,
+            if known.
+        '''
+        for extra in harvest_object.extras:
+            if extra.key == 'datestamp':
+                return dp(extra.value)
+        return None
+
+    def _save_harvested_record(self, harvest_object, record_hash):
+        ''' Remember the datestamp and hash of an imported record. '''
+        if not harvest_object.package_id:
+            return
+        record = HarvestedRecord.get(harvest_object.harvest_source_id, harvest_object.guid) or \
+            HarvestedRecord(harvest_source_id=harvest_object.harvest_source_id, guid=harvest_object.guid)
+        record.datestamp = self._remote_datestamp(harvest_object)
+        record.content_hash = record_hash
+        record.package_id = harvest_object.package_id
+        record.save()
+
     def parse_xml(self, f, context, orig_url=None, strict=True):
         """ Parse XML and return package data dictionary.
 
@@ -0,0 +1,152 @@
+'''Deferred search indexing of harvested datasets.
+
+CKAN indexes a dataset in the search index every time it's written, with a
+commit of the index for each dataset. While a :class:`DeferredIndexing` is
+active CKAN's ``synchronous_search`` plugin is unloaded, the ids of the
+datasets written in the process are collected and the datasets are reindexed
+in batches with a single commit each.
+'''
+import logging
+import threading
+
+from sqlalchemy import event
+
+from ckan import model, plugins
+
+log = logging.getLogger(__name__)
+
+INDEX_BATCH_SIZE = 1000
+
+SEARCH_PLUGIN = 'synchronous_search'
+
+
+class SearchIndexer(object):
+    '''Reindex datasets in the CKAN search index.'''
+
+    def index(self, package_ids):
+        from ckan.lib import search
+
+        # Skip datasets whose write was rolled back
+        existing = [package_id for package_id, in model.Session.query(model.Package.id).
+                    filter(model.Package.id.in_(package_ids))]
+        if existing:
+            search.rebuild(package_ids=existing, defer_commit=True)
+            search.commit()
+        return len(existing)
+
+
+_lock = threading.Lock()
+_active = []
+_unloaded = False
+
+
+def _written(session, flush_context):
+    '''Collect the ids of the datasets written while indexing is deferred.'''
+    package_ids = [obj.id for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+                   if isinstance(obj, model.Package) and obj.id]
+    if package_ids:
+        with _lock:
+            active = list(_active)
+        for indexing in active:
+            indexing.collect(package_ids)
+
+
+def _suspend(indexing):
+    '''Stop the indexing of written datasets, the first time unloading the
+    search plugin.
+    '''
+    global _unloaded
+    with _lock:
+        if not _active:
+            if plugins.plugin_loaded(SEARCH_PLUGIN):
+                plugins.unload(SEARCH_PLUGIN)
+                _unloaded = True
+            event.listen(model.Session, 'after_flush', _written)
+        _active.append(indexing)
+
+
+def _resume(indexing):
+    global _unloaded
+    with _lock:
+        _active.remove(indexing)
+        if not _active:
+            event.remove(model.Session, 'after_flush', _written)
+            if _unloaded:
+                plugins.load(SEARCH_PLUGIN)
+                _unloaded = False
+
+
+class DeferredIndexing(object):
+    '''Context manager turning off the automatic indexing of datasets and
+    indexing the written datasets in batches. The rest are indexed on exit.
+    The search plugin is unloaded for the whole process, so that the
+    datasets written by other code in the process are collected too, and it
+    shouldn't be used in a web server.
+
+    :param indexer: object with an ``index(package_ids)`` method,
+        :class:`SearchIndexer` by default
+    :param batch_size: number of datasets indexed at a time
+    :param max_delay: seconds after which collected datasets are indexed
+        in a background thread, or None to index them only in batches and
+        on exit
+    '''
+
+    def __init__(self, indexer=None, batch_size=INDEX_BATCH_SIZE, max_delay=None):
+        self.indexer = indexer or SearchIndexer()
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.package_ids = []
+        self._added = set()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __enter__(self):
+        _suspend(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.flush()
+        finally:
+            _resume(self)
+
+    def collect(self, package_ids):
+        '''Index written datasets with the next batch, without indexing a
+        full batch right away.
+        '''
+        with self._lock:
+            for package_id in package_ids:
+                if package_id and package_id not in self._added:
+                    self._added.add(package_id)
+                    self.package_ids.append(package_id)
+            if self.package_ids and self.max_delay is not None and self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self._delayed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return len(self.package_ids)
+
+    def add(self, package_id):
+        '''Index a committed dataset with the next batch.'''
+        if self.collect([package_id]) >= self.batch_size:
+            self.flush()
+
+    def _delayed_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            log.exception('Could not index deferred datasets')
+        finally:
+            model.Session.remove()
+
+    def flush(self):
+        '''Index the collected datasets.'''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            package_ids, self.package_ids = self.package_ids, []
+            self._added.clear()
+        if not package_ids:
+            return
+        self.indexer.index(package_ids)
+        log.debug('Indexed %d datasets', len(package_ids))
@@ -0,0 +1,168 @@
+'''Database tables of the OAI-PMH harvester.
+'''
+import logging
+
+from sqlalchemy import Column, Table, types
+
+from ckan.model.domain_object import DomainObject
+from ckan.model.meta import mapper, metadata, Session
+
+log = logging.getLogger(__name__)
+
+gather_checkpoint_table = None
+gather_identifier_table = None
+harvested_record_table = None
+set_watermark_table = None
+package_pid_table = None
+resource_change_table = None
+resource_table = None
+
+
+class GatherCheckpoint(DomainObject):
+    '''Progress of the ListIdentifiers walk of a harvest source, saved after
+    every page so that an interrupted gather can be resumed.
+    '''
+
+    @classmethod
+    def get(cls, harvest_source_id):
+        return Session.query(cls).filter(cls.harvest_source_id == harvest_source_id).first()
+
+
+class HarvestedRecord(DomainObject):
+    '''Remote datestamp and content hash of the last imported version of a
+    harvested record, used to skip unchanged records in the gather and
+    import stages.
+    '''
+
+    @classmethod
+    def get(cls, harvest_source_id, guid):
+        return Session.query(cls).filter(cls.harvest_source_id == harvest_source_id). \
+            filter(cls.guid == guid).first()
+
+
+class SetWatermark(DomainObject):
+    '''Latest remote datestamp harvested from a set of a source, where the
+    next incremental harvest of the set starts. The whole repository has the
+    set spec ''.
+    '''
+
+    @classmethod
+    def get(cls, harvest_source_id, set_spec):
+        return Session.query(cls).filter(cls.harvest_source_id == harvest_source_id). \
+            filter(cls.set_spec == set_spec).first()
+
+
+class PackagePid(DomainObject):
+    '''A PID of a dataset and its type, indexed for looking up datasets by
+    PID. Maintained from the ``pids_N_id`` and ``pids_N_type`` extras of
+    datasets by :mod:`ckanext.oaipmh.pids`.
+    '''
+    pass
+
+
+class ResourceChange(DomainObject):
+    '''A created, updated or deleted public dataset, published in the
+    ResourceSync change list by :mod:`ckanext.oaipmh.resourcesync`.
+    '''
+    pass
+
+
+class Resource(DomainObject):
+    '''A public dataset in the published ResourceSync resource list, kept
+    up to date by applying the logged changes.
+    '''
+
+    @classmethod
+    def get(cls, package_id):
+        return Session.query(cls).filter(cls.package_id == package_id).first()
+
+
+def define_tables():
+    global gather_checkpoint_table, gather_identifier_table, harvested_record_table, set_watermark_table, \
+        package_pid_table, resource_change_table, resource_table
+
+    gather_checkpoint_table = Table(
+        'oaipmh_gather_checkpoint', metadata,
+        Column('harvest_source_id', types.UnicodeText, primary_key=True),
+        # The sets and arguments of the walk, a checkpoint of another walk is discarded
+        Column('params', types.UnicodeText, nullable=False),
+        Column('set_spec', types.UnicodeText),
+        Column('resumption_token', types.UnicodeText),
+        Column('completed_sets', types.UnicodeText, nullable=False, default=u'[]'),
+        # Latest datestamps seen in each set so far
+        Column('watermarks', types.UnicodeText, nullable=False, default=u'{}'),
+    )
+    gather_identifier_table = Table(
+        'oaipmh_gather_identifier', metadata,
+        Column('id', types.Integer, primary_key=True),
+        Column('harvest_source_id', types.UnicodeText, nullable=False, index=True),
+        Column('identifier', types.UnicodeText, nullable=False),
+        Column('datestamp', types.DateTime),
+    )
+
+    harvested_record_table = Table(
+        'oaipmh_harvested_record', metadata,
+        Column('harvest_source_id', types.UnicodeText, primary_key=True),
+        Column('guid', types.UnicodeText, primary_key=True),
+        Column('datestamp', types.DateTime),
+        Column('content_hash', types.UnicodeText, nullable=False),
+        Column('package_id', types.UnicodeText, nullable=False),
+    )
+
+    set_watermark_table = Table(
+        'oaipmh_set_watermark', metadata,
+        Column('harvest_source_id', types.UnicodeText, primary_key=True),
+        Column('set_spec', types.UnicodeText, primary_key=True),
+        Column('datestamp', types.DateTime, nullable=False),
+    )
+
+    package_pid_table = Table(
+        'oaipmh_package_pid', metadata,
+        Column('pid', types.UnicodeText, primary_key=True),
+        Column('pid_type', types.UnicodeText, primary_key=True),
+        Column('package_id', types.UnicodeText, primary_key=True, index=True),
+    )
+
+    # Append-only log of dataset changes, in the order they were made
+    resource_change_table = Table(
+        'oaipmh_resource_change', metadata,
+        Column('id', types.Integer, primary_key=True),
+        Column('package_id', types.UnicodeText, nullable=False),
+        Column('change', types.UnicodeText, nullable=False),
+        Column('lastmod', types.DateTime, nullable=False),
+        Column('datetime', types.DateTime, nullable=False),
+        # Whether the change has been applied to the resource list
+        Column('published', types.Boolean, nullable=False, default=False, index=True),
+    )
+
+    resource_table = Table(
+        'oaipmh_resource', metadata,
+        Column('package_id', types.UnicodeText, primary_key=True),
+        Column('lastmod', types.DateTime, nullable=False),
+    )
+
+    mapper(GatherCheckpoint, gather_checkpoint_table)
+    mapper(HarvestedRecord, harvested_record_table)
+    mapper(SetWatermark, set_watermark_table)
+    mapper(PackagePid, package_pid_table)
+    mapper(ResourceChange, resource_change_table)
+    mapper(Resource, resource_table)
+
+
+def setup():
+    '''Define the tables and create the missing ones.
+
+    :returns: the names of the created tables
+    '''
+    if gather_checkpoint_table is None:
+        define_tables()
+        log.debug('OAI-PMH tables defined in memory')
+
+    created = []
+    for table in (gather_checkpoint_table, gather_identifier_table, harvested_record_table,
+                  set_watermark_table, package_pid_table, resource_change_table, resource_table):
+        if not table.exists():
+            table.create()
+            created.append(table.name)
+            log.debug('OAI-PMH table %s created', table.name)
+    return created
@@ -8,18 +8,27 @@ from oaipmh import common
 from oaipmh.common import ResumptionOAIPMH
 from oaipmh.error import IdDoesNotExistError
 import ckan.plugins.toolkit as toolkit
-from sqlalchemy import between
+from rdflib import Graph
+from sqlalchemy import between, func, not_, or_
 
 from ckan.lib.helpers import url_for
+from ckan import model
 from ckan.logic import get_action
-from ckan.model import Package, Session, Group, PackageRevision
+from ckan.model import Package, PackageExtra, Session, Group, Member, PackageRevision
+from ckan.plugins import IPackageController, PluginImplementations
+from ckan.plugins.toolkit import config
 from ckanext.dcat.processors import RDFSerializer
 from ckanext.kata import helpers
 from ckanext.oaipmh.utils import get_earliest_datestamp
 
 log = logging.getLogger(__name__)
 
-rdfserializer = RDFSerializer()
+def get_compression():
+    '''Return the content codings enabled in ``ckanext.oaipmh.compression``
+    (default: gzip deflate) in order of preference.
+    '''
+    return [coding for coding in config.get('ckanext.oaipmh.compression', 'gzip deflate').split()
+            if coding in ('gzip', 'deflate')]
 
 
 class CKANServer(ResumptionOAIPMH):
@@ -36,7 +45,7 @@ class CKANServer(ResumptionOAIPMH):
             earliestDatestamp=get_earliest_datestamp(),
             deletedRecord='no',
             granularity='YYYY-MM-DDThh:mm:ssZ',
-            compression=['identity'])
+            compression=['identity'] + get_compression())
 
     def _get_json_content(self, js):
         '''
@@ -55,22 +64,31 @@ class CKANServer(ResumptionOAIPMH):
         except:
             return [js]
 
-    def _record_for_dataset_dcat(self, dataset, spec):
+    def _record_for_dataset_dcat(self, dataset, spec, package, serializer=None):
         '''Show a tuple of a header and metadata for this dataset.
         Note that dataset_xml (metadata) returned is just a string containing
         ready rdf xml. This is contrary to the common practice of pyoia's
         getRecord method.
+
+        :param package: the dataset dict, see :meth:`_package_dicts`
+        :param serializer: RDFSerializer to reuse, e.g. for all records of
+            a page, so that the profiles are loaded once
         '''
-        package = get_action('package_show')({}, {'id': dataset.id})
-        dataset_xml = rdfserializer.serialize_dataset(package, _format='xml')
+        serializer = serializer or RDFSerializer()
+        # The serializer adds every dataset to its graph, each record gets
+        # an empty one
+        serializer.g = Graph()
+        dataset_xml = serializer.serialize_dataset(package, _format='xml')
         return (common.Header('', dataset.id, dataset.metadata_created, [spec], False),
                 dataset_xml, None)
 
-    def _record_for_dataset(self, dataset, spec):
+    def _record_for_dataset(self, dataset, spec, extras, package):
         '''Show a tuple of a header and metadata for this dataset.
-        '''
-        package = get_action('package_show')({}, {'id': dataset.id})
 
+        :param extras: the extras of the dataset to include in the metadata,
+            see :meth:`_package_extras`
+        :param package: the dataset dict, see :meth:`_package_dicts`
+        '''
         coverage = []
         temporal_begin = package.get('temporal_coverage_begin', '')
         temporal_end = package.get('temporal_coverage_end', '')
@@ -98,7 +116,7 @@ class CKANServer(ResumptionOAIPMH):
                 'rights': [package['license_title']] if package.get('license_title', None) else None,
                 'coverage': coverage if coverage else None, }
 
-        iters = dataset.extras.items()
+        iters = extras.items()
         meta = dict(iters + meta.items())
         metadata = {}
         # Fixes the bug on having a large dataset being scrambled to individual
@@ -111,45 +129,88 @@ class CKANServer(ResumptionOAIPMH):
         return (common.Header('', dataset.id, dataset.metadata_created, [spec], False),
                 common.Metadata('', metadata), None)
 
+    @staticmethod
+    def _extra_key_patterns(option):
+        '''Convert a space separated list of glob patterns from the config
+        to SQL LIKE patterns.
+        '''
+        return [pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').
+                replace('*', '%').replace('?', '_')
+                for pattern in config.get(option, '').split()]
+
+    def _package_extras(self, package_ids):
+        '''Get the extras of the given datasets for the oai_dc metadata with
+        a single query. Extras are filtered in SQL by the glob patterns in
+        ``ckanext.oaipmh.extras.include`` (default: all) and
+        ``ckanext.oaipmh.extras.exclude``, so unneeded extras are never
+        loaded.
+
+        :returns: dict of package id to a dict of extras
+        '''
+        extras = dict((package_id, {}) for package_id in package_ids)
+        if not package_ids:
+            return extras
+        query = Session.query(PackageExtra.package_id, PackageExtra.key, PackageExtra.value). \
+            filter(PackageExtra.package_id.in_(package_ids)). \
+            filter(PackageExtra.state == 'active')
+        include = self._extra_key_patterns('ckanext.oaipmh.extras.include')
+        if include:
+            query = query.filter(or_(*[PackageExtra.key.like(pattern, escape='\\') for pattern in include]))
+        for pattern in self._extra_key_patterns('ckanext.oaipmh.extras.exclude'):
+            query = query.filter(not_(PackageExtra.key.like(pattern, escape='\\')))
+        for package_id, key, value in query:
+            extras[package_id][key] = value
+        return extras
+
+    @staticmethod
+    def _package_dicts(packages):
+        '''Get the dataset dicts of the given public datasets like
+        package_show does, with a single search instead of a package_show of
+        each. package_show takes the validated dict of a dataset from the
+        search index when the index is up to date, and runs the `read` and
+        `after_show` hooks of the plugins on it, which is done here for the
+        whole page. Datasets missing from the index or indexed at another
+        modification time are shown with package_show.
+
+        :param packages: list of Package objects
+        :returns: dict of package id to dataset dict
+        '''
+        if not packages:
+            return {}
+        result = get_action('package_search')({}, {
+            'fq': '+id:(%s)' % ' OR '.join('"%s"' % package.id for package in packages),
+            'fl': 'id validated_data_dict',
+            'rows': len(packages),
+            'facet': 'false'})
+        indexed = dict((row['id'], json.loads(row['validated_data_dict']))
+                       for row in result['results'] if row.get('validated_data_dict'))
+        package_dicts = {}
+        for package in packages:
+            package_dict = indexed.get(package.id)
+            if not package_dict or not package.metadata_modified or \
+                    package_dict.get('metadata_modified') != package.metadata_modified.isoformat():
+                package_dicts[package.id] = get_action('package_show')({}, {'id': package.id})
+                continue
+            context = {'model': model, 'session': Session, 'package': package}
+            for plugin in PluginImplementations(IPackageController):
+                plugin.read(package)
+            for plugin in PluginImplementations(IPackageController):
+                plugin.after_show(context, package_dict)
+            package_dicts[package.id] = package_dict
+        return package_dicts
+
     @staticmethod
     def _filter_packages(set, cursor, from_, until, batch_size):
-        '''Get a part of datasets for "listNN" verbs.
+        '''Get a part of datasets for "ListRecords", the same page as
+        :meth:`_filter_package_headers`.
+
+        :returns: list of (Package, org_name) tuples and the group matching
+            the set, if any
         '''
-        packages = []
-        group = None
-        if not set:
-            packages = Session.query(Package).filter(Package.type=='dataset'). \
-                filter(Package.state == 'active').filter(Package.private!=True)
-            if from_ and not until:
-                packages = packages.filter(PackageRevision.revision_timestamp > from_).\
-                    filter(Package.name==PackageRevision.name)
-            if until and not from_:
-                packages = packages.filter(PackageRevision.revision_timestamp < until).\
-                    filter(Package.name==PackageRevision.name)
-            if from_ and until:
-                packages = packages.filter(between(PackageRevision.revision_timestamp, from_, until)).\
-                    filter(Package.name==PackageRevision.name)
-            packages = packages.all()
-        else:
-            group = Group.get(set)
-            if group:
-                # Note that group.packages never returns private datasets regardless of 'with_private' parameter.
-                packages = group.packages(return_query=True, with_private=False).filter(Package.type=='dataset'). \
-                    filter(Package.state == 'active')
-                if from_ and not until:
-                    packages = packages.filter(PackageRevision.revision_timestamp > from_).\
-                        filter(Package.name==PackageRevision.name)
-                if until and not from_:
-                    packages = packages.filter(PackageRevision.revision_timestamp < until).\
-                        filter(Package.name==PackageRevision.name)
-                if from_ and until:
-                    packages = packages.filter(between(PackageRevision.revision_timestamp, from_, until)).\
-                        filter(Package.name==PackageRevision.name)
-                packages = packages.all()
-        if cursor is not None:
-            cursor_end = cursor + batch_size if cursor + batch_size < len(packages) else len(packages)
-            packages = packages[cursor:cursor_end]
-        return packages, group
+        query, group = CKANServer._page_query(set, cursor, from_, until, batch_size, Package, Group.name)
+        if query is None:
+            return [], None
+        return query.all(), group
 
     def getRecord(self, metadataPrefix, identifier):
         '''Simple getRecord for a dataset.
@@ -162,26 +223,115 @@ class CKANServer(ResumptionOAIPMH):
             group = Group.get(package.owner_org)
             if group and group.name:
                 spec = group.name
+        package_dict = get_action('package_show')({}, {'id': package.id})
         if metadataPrefix == 'rdf':
-            return self._record_for_dataset_dcat(package, spec)
-        return self._record_for_dataset(package, spec)
+            return self._record_for_dataset_dcat(package, spec, package_dict)
+        return self._record_for_dataset(package, spec, self._package_extras([package.id])[package.id],
+                                        package_dict)
+
+    @staticmethod
+    def _window_query(set, from_, until, *columns):
+        '''Query the given columns of the public datasets in a set and
+        from/until window. The owner organization is outer joined as
+        `Group`.
+
+        :returns: the query, or None if the set does not exist, and the
+            group matching the set, if any
+        '''
+        query = Session.query(*columns). \
+            select_from(Package). \
+            outerjoin(Group, Group.id == Package.owner_org). \
+            filter(Package.type == 'dataset'). \
+            filter(Package.state == 'active').filter(Package.private != True)
+        group = None
+        if set:
+            group = Group.get(set)
+            if not group:
+                return None, None
+            query = query.join(Member, Member.table_id == Package.id). \
+                filter(Member.table_name == 'package'). \
+                filter(Member.state == 'active'). \
+                filter(Member.group_id == group.id)
+        if from_ or until:
+            # A dataset is in the window if any of its revisions is. EXISTS
+            # keeps one row per dataset however many revisions match.
+            revisions = Session.query(PackageRevision.id).filter(PackageRevision.id == Package.id)
+            if from_ and not until:
+                revisions = revisions.filter(PackageRevision.revision_timestamp > from_)
+            if until and not from_:
+                revisions = revisions.filter(PackageRevision.revision_timestamp < until)
+            if from_ and until:
+                revisions = revisions.filter(between(PackageRevision.revision_timestamp, from_, until))
+            query = query.filter(revisions.exists())
+        return query, group
+
+    @staticmethod
+    def _page_query(set, cursor, from_, until, batch_size, *columns):
+        '''Query the given columns of the page starting at `cursor` of
+        the window of :meth:`_window_query`. The list verbs and the
+        validators of their responses all use this query.
+
+        :returns: the query, or None if the set does not exist, and the
+            group matching the set, if any
+        '''
+        query, group = CKANServer._window_query(set, from_, until, *columns)
+        if query is None:
+            return None, None
+        query = query.order_by(Package.id)
+        if cursor is not None:
+            query = query.offset(cursor).limit(batch_size)
+        return query, group
+
+    @staticmethod
+    def _filter_package_headers(set, cursor, from_, until, batch_size):
+        '''Get a part of dataset headers for "ListIdentifiers".
+
+        Selects only the columns a header needs, with the owner
+        organization name joined in, instead of full `Package` objects.
+        Rows are streamed with a server-side cursor.
+
+        :returns: iterator of (id, metadata_created, name, org_name) tuples
+            and the group matching the set, if any
+        '''
+        query, group = CKANServer._page_query(set, cursor, from_, until, batch_size, Package.id,
+                                              Package.metadata_created, Package.name, Group.name)
+        if query is None:
+            return [], None
+        return query.execution_options(stream_results=True).yield_per(batch_size or 100), group
+
+    def last_modified(self, identifier=None, set=None, from_=None, until=None, cursor=None, batch_size=None):
+        '''Get the state of the datasets a response is made of, for
+        conditional requests: the dataset with `identifier`, or the page of
+        public datasets in a set and from/until window that the list verbs
+        serve from `cursor`.
+
+        :returns: tuple of the latest metadata_modified and a fingerprint of
+            the ids and metadata_modified of the datasets, or None if there
+            are no such datasets
+        '''
+        if identifier:
+            # Deleting a dataset doesn't change its metadata_modified
+            package = Package.get(identifier)
+            rows = [(package.id, package.metadata_modified)] if package and package.state == 'active' else []
+        else:
+            query, _group = self._page_query(set, cursor, from_, until, batch_size,
+                                             Package.id, Package.metadata_modified)
+            rows = query.all() if query is not None else []
+        rows = [(package_id, modified) for package_id, modified in rows if modified]
+        if not rows:
+            return None
+        fingerprint = [(package_id, modified.isoformat()) for package_id, modified in rows]
+        return max(modified for _package_id, modified in rows), fingerprint
 
     def listIdentifiers(self, metadataPrefix=None, set=None, cursor=None,
                         from_=None, until=None, batch_size=None):
         '''List all identifiers for this repository.
         '''
         data = []
-        packages, group = self._filter_packages(set, cursor, from_, until, batch_size)
-        for package in packages:
-            spec = package.name
-            if group:
-                spec = group.name
-            else:
-                if package.owner_org:
-                    group = Group.get(package.owner_org)
-                    if group and group.name:
-                        spec = group.name
-            data.append(common.Header('', package.id, package.metadata_created, [spec], False))
+        rows, group = self._filter_package_headers(set, cursor, from_, until, batch_size)
+        for package_id, created, name, org_name in rows:
+            spec = group.name if group else org_name or name
+            data.append(common.Header('', package_id, created, [spec], False))
         return data
 
     def listMetadataFormats(self, identifier=None):
@@ -198,22 +348,17 @@ class CKANServer(ResumptionOAIPMH):
                     until=None, batch_size=None):
         '''Show a selection of records, basically lists all datasets.
         '''
-        data = []
-        packages, group = self._filter_packages(set, cursor, from_, until, batch_size)
-        for package in packages:
-            spec = package.name
-            if group:
-                spec = group.name
-            else:
-                if package.owner_org:
-                    group = Group.get(package.owner_org)
-                    if group and group.name:
-                        spec = group.name
-            if metadataPrefix == 'rdf':
-                data.append(self._record_for_dataset_dcat(package, spec))
-            else:
-                data.append(self._record_for_dataset(package, spec))
-        return data
+        rows, group = self._filter_packages(set, cursor, from_, until, batch_size)
+        packages = [package for package, _org_name in rows]
+        specs = [group.name if group else org_name or package.name for package, org_name in rows]
+        package_dicts = self._package_dicts(packages)
+        if metadataPrefix == 'rdf':
+            serializer = RDFSerializer()
+            return [self._record_for_dataset_dcat(package, spec, package_dicts[package.id], serializer)
+                    for package, spec in zip(packages, specs)]
+        extras = self._package_extras([package.id for package in packages])
+        return [self._record_for_dataset(package, spec, extras[package.id], package_dicts[package.id])
+                for package, spec in zip(packages, specs)]
 
     def listSets(self, cursor=None, batch_size=None):
         '''List all sets in this repository, where sets are groups.
@@ -0,0 +1,103 @@
+'''Partitioned gathering of the identifiers of a source.
+
+The ListIdentifiers walk is split into partitions, one per set or per
+datestamp window of a set, which are listed concurrently by a thread pool.
+Each thread uses its own client. The headers are handed to the calling
+thread through a bounded queue, so that a slow consumer holds the workers
+back instead of filling the memory.
+'''
+import datetime
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import oaipmh.error
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def date_windows(start, days, day_granularity=False, end=None):
+    '''Split the time from `start` to `end`, or to now without `end`, into
+    windows of `days` days which don't overlap at the granularity of the
+    source.
+
+    :returns: list of (from, until) pairs, the until of the last window is
+        `end`
+    '''
+    step = datetime.timedelta(days=days)
+    unit = datetime.timedelta(days=1) if day_granularity else datetime.timedelta(seconds=1)
+    if day_granularity:
+        start = datetime.datetime(start.year, start.month, start.day)
+    limit = end or datetime.datetime.utcnow()
+    windows = []
+    while start + step <= limit:
+        windows.append((start, start + step - unit))
+        start += step
+    windows.append((start, end))
+    return windows
+
+
+def list_partitions(harvester, partitions, url, registry, workers, day_granularity=False, queue_size=1000):
+    '''List the identifiers of partitions concurrently.
+
+    :param harvester: the OAIPMHHarvester creating the clients
+    :param partitions: list of (set spec, ListIdentifiers arguments) pairs
+    :param url: OAI-PMH base URL of the source
+    :param registry: metadata registry for the clients
+    :param workers: number of partitions listed at a time
+    :param day_granularity: whether the source has day granularity
+    :param queue_size: number of headers buffered for the caller
+    :returns: generator of (set spec, identifier, datestamp) tuples
+    :raises: the first error of a partition
+    '''
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    local = threading.local()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def walk(partition):
+        if stop.is_set():
+            return
+        set_spec, kwargs = partition
+        try:
+            if not hasattr(local, 'client'):
+                local.client = harvester.create_client(url, registry)
+                local.client._day_granularity = day_granularity
+            try:
+                for header in local.client.listIdentifiers(**kwargs):
+                    if not put((set_spec, header.identifier(), header.datestamp())):
+                        return
+            except oaipmh.error.NoRecordsMatchError:
+                pass
+        except Exception as e:
+            put((_DONE, e))
+            return
+        put((_DONE, None))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for partition in partitions:
+            executor.submit(walk, partition)
+        remaining = len(partitions)
+        while remaining:
+            item = results.get()
+            if item[0] is _DONE:
+                remaining -= 1
+                if item[1] is not None:
+                    raise item[1]
+            else:
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
@@ -0,0 +1,167 @@
+'''Index of dataset PIDs.
+
+The PIDs of a dataset are kept in its ``pids_N_id`` and ``pids_N_type``
+extras, which can only be searched with a ``LIKE`` scan of the extras.
+They are copied to the indexed ``oaipmh_package_pid`` table whenever a
+dataset is written, and looked up there. :func:`rebuild` fills the table
+from the extras of all datasets.
+
+The table is kept up to date by the ``oaipmh`` plugin. Without the plugin,
+PIDs that aren't in the table are looked up in the extras.
+'''
+import logging
+
+from ckan import model, plugins
+from ckan.model import Session
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh.model import PackagePid
+
+log = logging.getLogger(__name__)
+
+
+def _pids(rows):
+    '''Pair the PID ids and types of (package id, key, value) extras rows.
+
+    :returns: list of {'pid', 'pid_type', 'package_id'} dicts
+    '''
+    pids = {}
+    for package_id, key, value in rows:
+        parts = key.split('_')
+        if len(parts) == 3 and parts[2] in ('id', 'type'):
+            pids.setdefault((package_id, parts[1]), {})[parts[2]] = value
+    return [{'pid': pid['id'], 'pid_type': pid.get('type') or u'', 'package_id': package_id}
+            for (package_id, _number), pid in pids.items() if pid.get('id')]
+
+
+def _pid_extras():
+    return Session.query(model.PackageExtra.package_id, model.PackageExtra.key, model.PackageExtra.value). \
+        filter(model.PackageExtra.key.like('pids_%')). \
+        filter(model.PackageExtra.state == 'active')
+
+
+def _insert(pids):
+    # The same PID may be listed twice in a dataset
+    unique = dict(((pid['pid'], pid['pid_type'], pid['package_id']), pid) for pid in pids)
+    if unique:
+        Session.execute(oaipmh_model.package_pid_table.insert(), list(unique.values()))
+
+
+def index_package(package_id):
+    '''Replace the indexed PIDs of a dataset with the PIDs in its extras.
+    Doesn't commit.
+    '''
+    table = oaipmh_model.package_pid_table
+    Session.execute(table.delete().where(table.c.package_id == package_id))
+    _insert(_pids(_pid_extras().filter(model.PackageExtra.package_id == package_id)))
+
+
+def setup():
+    '''Create the tables, and index the PIDs of all datasets if the PID
+    table is new.
+    '''
+    if 'oaipmh_package_pid' in oaipmh_model.setup():
+        rebuild()
+
+
+def rebuild():
+    '''Index the PIDs of all datasets.
+
+    :returns: the number of indexed PIDs
+    '''
+    Session.execute(oaipmh_model.package_pid_table.delete())
+    pids = _pids(_pid_extras().yield_per(1000))
+    _insert(pids)
+    Session.commit()
+    log.info('Indexed %d PIDs', len(pids))
+    return len(pids)
+
+
+def _lookup(pid):
+    return Session.query(PackagePid.package_id, PackagePid.pid_type). \
+        join(model.Package, model.Package.id == PackagePid.package_id). \
+        filter(model.Package.state == 'active'). \
+        filter(PackagePid.pid == pid)
+
+
+def _lookup_extras(pid):
+    '''Return the (package id, PID type) pairs of the active datasets with
+    the PID from the extras.
+    '''
+    matches = Session.query(model.PackageExtra.package_id). \
+        filter(model.PackageExtra.key.like('pids_%')). \
+        filter(model.PackageExtra.value == pid). \
+        filter(model.PackageExtra.state == 'active')
+    rows = _pid_extras(). \
+        join(model.Package, model.Package.id == model.PackageExtra.package_id). \
+        filter(model.Package.state == 'active'). \
+        filter(model.PackageExtra.package_id.in_(matches.subquery()))
+    return [(row['package_id'], row['pid_type']) for row in _pids(rows) if row['pid'] == pid]
+
+
+def _fall_back():
+    # Without the plugin the table may miss datasets written since it was filled
+    return not plugins.plugin_loaded('oaipmh')
+
+
+def _primary_package_id(rows):
+    '''Return the package id of (package id, PID type) rows of a PID if
+    they are all of one dataset and of type primary.
+    '''
+    package_ids = set(package_id for package_id, _pid_type in rows)
+    if len(package_ids) != 1:
+        return None              # Nothing to do if we get many or zero datasets
+    if any(pid_type != 'primary' for _package_id, pid_type in rows):
+        return None              # Found a hit with wrong type of PID
+    return package_ids.pop()
+
+
+def get_package_id_by_pid(pid, pid_type):
+    """ Find pid by id and type.
+    :param pid: id of the pid
+    :param pid_type: type of the pid (primary, relation)
+    :return: id of the package
+    """
+    row = _lookup(pid).filter(PackagePid.pid_type == pid_type).first()
+    if row:
+        return row.package_id
+    if _fall_back():
+        for package_id, row_type in _lookup_extras(pid):
+            if row_type == pid_type:
+                return package_id
+    return None
+
+
+def get_package_id_by_primary_pid(pid):
+    '''Return the id of the only active dataset with the PID, if it's the
+    primary PID of the dataset.
+    '''
+    rows = _lookup(pid).all()
+    if not rows and _fall_back():
+        rows = _lookup_extras(pid)
+    return _primary_package_id(rows)
+
+
+def get_package_ids_by_primary_pids(primary_pids):
+    '''Resolve many PIDs like :func:`get_package_id_by_primary_pid` with a
+    single query.
+
+    :returns: dict of the ids of the found datasets by PID
+    '''
+    primary_pids = set(primary_pids)
+    rows = {}
+    if primary_pids:
+        query = Session.query(PackagePid.pid, PackagePid.package_id, PackagePid.pid_type). \
+            join(model.Package, model.Package.id == PackagePid.package_id). \
+            filter(model.Package.state == 'active'). \
+            filter(PackagePid.pid.in_(list(primary_pids)))
+        for pid, package_id, pid_type in query:
+            rows.setdefault(pid, []).append((package_id, pid_type))
+        if _fall_back():
+            for pid in primary_pids - set(rows):
+                rows[pid] = _lookup_extras(pid)
+    package_ids = {}
+    for pid, pid_rows in rows.items():
+        package_id = _primary_package_id(pid_rows)
+        if package_id:
+            package_ids[pid] = package_id
+    return package_ids
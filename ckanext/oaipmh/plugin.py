@@ -1,7 +1,11 @@
 import logging
 import os
+from dateutil.parser import parse as dp
+
+from ckan import model
 from ckan.plugins import implements, SingletonPlugin
-from ckan.plugins import IRoutes, IConfigurer
+from ckan.plugins import IRoutes, IConfigurer, IConfigurable, IPackageController
+from ckanext.oaipmh import cache, pids, resourcesync
 
 log = logging.getLogger(__name__)
 
@@ -13,6 +17,13 @@ class OAIPMHPlugin(SingletonPlugin):
     '''
     implements(IRoutes, inherit=True)
     implements(IConfigurer)
+    implements(IConfigurable)
+    implements(IPackageController, inherit=True)
+
+    def configure(self, config):
+        cache.setup()
+        pids.setup()
+        resourcesync.setup()
 
     def update_config(self, config):
         """This IConfigurer implementation causes CKAN to look in the
@@ -30,9 +41,60 @@ class OAIPMHPlugin(SingletonPlugin):
                                     'oaipmh', 'templates')
         config['extra_template_paths'] = ','.join([template_dir, config.get('extra_template_paths', '')])
 
+        public_path = resourcesync.get_public_path()
+        if public_path:
+            if not os.path.isdir(public_path):
+                os.makedirs(public_path)
+            config['extra_public_paths'] = ','.join([public_path, config.get('extra_public_paths', '')])
+
     def before_map(self, map):
         '''Map the controller to be used for OAI-PMH.
         '''
         controller = 'ckanext.oaipmh.controller:OAIPMHController'
         map.connect('oai', '/oai', controller=controller, action='index')
         return map
+
+    def _resourcesync_change(self, pkg_dict):
+        '''Log a change of the dataset for the ResourceSync change list if
+        it is or was public. Failures are logged and never prevent the
+        dataset from being written.
+        '''
+        if not resourcesync.get_public_path():
+            return
+        if pkg_dict.get('type', 'dataset') != 'dataset':
+            return
+        public = pkg_dict.get('private') not in (True, 'True', 'true') and \
+            pkg_dict.get('state', 'active') == 'active'
+        modified = pkg_dict.get('metadata_modified')
+        try:
+            resourcesync.record_change(pkg_dict['id'], public, dp(modified) if modified else None)
+        except Exception:
+            log.exception('ResourceSync: could not record a change of %s', pkg_dict.get('id'))
+
+    def _invalidate_responses(self):
+        try:
+            cache.invalidate_after_commit()
+        except Exception:
+            log.exception('Could not invalidate cached OAI-PMH responses')
+
+    def _index_pids(self, pkg_dict):
+        try:
+            pids.index_package(pkg_dict['id'])
+        except Exception:
+            log.exception('Could not index the PIDs of %s', pkg_dict.get('id'))
+
+    def after_create(self, context, pkg_dict):
+        self._invalidate_responses()
+        self._index_pids(pkg_dict)
+        self._resourcesync_change(pkg_dict)
+
+    def after_update(self, context, pkg_dict):
+        self._invalidate_responses()
+        self._index_pids(pkg_dict)
+        self._resourcesync_change(pkg_dict)
+
+    def after_delete(self, context, pkg_dict):
+        self._invalidate_responses()
+        package = model.Package.get(pkg_dict.get('id'))
+        if package:
+            self._resourcesync_change({'id': package.id, 'type': package.type, 'state': 'deleted'})
@@ -0,0 +1,166 @@
+'''Retries and circuit breaking of the requests to an OAI-PMH source.
+
+A :class:`RequestPolicy` is shared by all clients of a source. Transient
+failures (timeouts, connection errors, 429 and 5xx replies) are retried
+with jittered exponential backoff. A ``Retry-After`` reply pauses the
+whole source for the given time, and after repeated failures the circuit
+opens: requests wait for a cooldown, then a single trial request decides
+whether the source is back or the cooldown is doubled.
+'''
+import email.utils
+import http.client
+import logging
+import random
+import threading
+import time
+import urllib.error
+
+log = logging.getLogger(__name__)
+
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+
+def is_transient(error):
+    '''Whether a failed request is worth retrying.'''
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in TRANSIENT_STATUSES
+    return isinstance(error, (IOError, http.client.HTTPException))
+
+
+def retry_after(error, now=None):
+    '''Return the delay in seconds requested by the ``Retry-After`` header
+    of an HTTP error, or None.
+    '''
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - (now if now is not None else time.time()))
+
+
+class RequestPolicy(object):
+    '''Retry policy and circuit breaker of a source.
+
+    :param retries: number of retries of a failed request
+    :param backoff: base delay of the exponential backoff in seconds
+    :param max_backoff: upper bound of a single backoff delay
+    :param failure_threshold: consecutive failures that open the circuit
+    :param cooldown: time the circuit stays open at first, doubled after
+        every failed trial request up to `max_cooldown`
+    :param max_cooldown: upper bound of the cooldown and of a
+        ``Retry-After`` pause
+    '''
+
+    probe_interval = 1.0
+
+    def __init__(self, retries=4, backoff=1.0, max_backoff=60.0, failure_threshold=5,
+                 cooldown=30.0, max_cooldown=600.0, sleep=time.sleep, clock=time.time):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = None
+        self._cooldown = cooldown
+        self._probing = False
+        self._sleep = sleep
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        '''Wait while the source is paused. After the pause only one
+        request at a time goes through until one has succeeded.
+        '''
+        while True:
+            with self._lock:
+                if self.open_until is None:
+                    return
+                wait = self.open_until - self._clock()
+                if wait <= 0 and not self._probing:
+                    self._probing = True
+                    return
+            self._sleep(max(wait, self.probe_interval))
+
+    def _succeeded(self):
+        with self._lock:
+            if self.open_until is not None:
+                log.info('Source is responding again, closing circuit')
+            self.failures = 0
+            self.open_until = None
+            self._probing = False
+            self._cooldown = self.cooldown
+
+    def _failed(self, pause=None):
+        with self._lock:
+            self.failures += 1
+            now = self._clock()
+            if self._probing:
+                self._cooldown = min(self._cooldown * 2, self.max_cooldown)
+                self.open_until = now + self._cooldown
+                self._probing = False
+                log.warning('Trial request failed, pausing source for %.0f s', self._cooldown)
+            elif self.failures >= self.failure_threshold and self.open_until is None:
+                self.open_until = now + self._cooldown
+                log.warning('%d consecutive failures, pausing source for %.0f s',
+                            self.failures, self._cooldown)
+            if pause is not None:
+                until = now + min(pause, self.max_cooldown)
+                if self.open_until is None or until > self.open_until:
+                    self.open_until = until
+
+    def delay(self, attempt):
+        '''Return a random backoff delay for the given retry (0 based).'''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, request):
+        '''Call `request` following the policy and return its result.
+
+        :param request: function sending the request
+        :raises: the error of the last attempt when all have failed
+        '''
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                result = request()
+            except Exception as e:
+                if not is_transient(e):
+                    with self._lock:
+                        self._probing = False
+                    raise
+                pause = retry_after(e, self._clock())
+                self._failed(pause)
+                if attempt >= self.retries:
+                    raise
+                log.info('Request failed, retry %d of %d: %s', attempt + 1, self.retries, e)
+                if pause is None:
+                    self._sleep(self.delay(attempt))
+                attempt += 1
+            else:
+                self._succeeded()
+                return result
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(source_url, **options):
+    '''Return the process wide policy of a source, created with `options`.
+
+    :rtype: RequestPolicy
+    '''
+    with _policies_lock:
+        policy = _policies.get(source_url)
+        if policy is None:
+            policy = _policies[source_url] = RequestPolicy(**options)
+        return policy
@@ -0,0 +1,270 @@
+'''ResourceSync capability, resource and change lists for CKAN datasets.
+
+Changes to the public visibility and content of datasets are appended to
+a change log table within the transaction of the write. The log is applied
+to the table of published resources and the documents are written as
+static files out of band by :func:`publish`, so that consumers can fetch
+one small, cacheable document instead of polling ListIdentifiers.
+'''
+import datetime
+import fcntl
+import logging
+import os
+import tempfile
+import urllib.parse
+from contextlib import contextmanager
+
+from lxml import etree
+
+from ckan.model import Package, Session
+from ckan.plugins.toolkit import config
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh.model import Resource, ResourceChange
+
+log = logging.getLogger(__name__)
+
+NS_SITEMAP = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+NS_RS = 'http://www.openarchives.org/rs/terms/'
+NSMAP = {None: NS_SITEMAP, 'rs': NS_RS}
+
+DIRECTORY = 'resourcesync'
+CAPABILITY_LIST = 'capabilitylist.xml'
+RESOURCE_LIST = 'resourcelist.xml'
+CHANGE_LIST = 'changelist.xml'
+
+
+def nssm(name):
+    return '{%s}%s' % (NS_SITEMAP, name)
+
+
+def nsrs(name):
+    return '{%s}%s' % (NS_RS, name)
+
+
+def get_public_path():
+    '''Return the directory served as static files that holds the
+    ``resourcesync`` documents, or None if publication is disabled.
+
+    Configured with ``ckanext.oaipmh.resourcesync.public_path`` and
+    defaults to ``oaipmh_public`` under ``ckan.storage_path``.
+    '''
+    path = config.get('ckanext.oaipmh.resourcesync.public_path')
+    if not path and config.get('ckan.storage_path'):
+        path = os.path.join(config.get('ckan.storage_path'), 'oaipmh_public')
+    return path or None
+
+
+def _directory():
+    return os.path.join(get_public_path(), DIRECTORY)
+
+
+def _document_url(filename):
+    return '%s/%s/%s' % (config.get('ckan.site_url', '').rstrip('/'), DIRECTORY, filename)
+
+
+def _record_url(package_id):
+    '''The OAI-PMH GetRecord URL of a dataset, used as the ResourceSync
+    resource location.
+    '''
+    return '%s/oai?%s' % (config.get('ckan.site_url', '').rstrip('/'),
+                          urllib.parse.urlencode([('verb', 'GetRecord'),
+                                                  ('metadataPrefix', 'oai_dc'),
+                                                  ('identifier', package_id)]))
+
+
+def _w3c(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+@contextmanager
+def _locked():
+    '''Serialize updates of the documents between processes.'''
+    directory = _directory()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield directory
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _new_document(capability, **attributes):
+    root = etree.Element(nssm('urlset'), nsmap=NSMAP)
+    if capability != 'capabilitylist':
+        etree.SubElement(root, nsrs('ln'), rel='up', href=_document_url(CAPABILITY_LIST))
+    md = etree.SubElement(root, nsrs('md'), capability=capability)
+    for key, value in attributes.items():
+        md.set(key, value)
+    return root
+
+
+def _write(root, path):
+    '''Replace the document atomically so readers never see partial files.'''
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, 'wb') as tmp:
+        tmp.write(etree.tostring(root, xml_declaration=True, encoding='UTF-8', pretty_print=True))
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+
+def _url_element(parent, loc, lastmod=None):
+    url = etree.SubElement(parent, nssm('url'))
+    etree.SubElement(url, nssm('loc')).text = loc
+    if lastmod:
+        etree.SubElement(url, nssm('lastmod')).text = lastmod
+    return url
+
+
+def _write_capability_list(directory):
+    path = os.path.join(directory, CAPABILITY_LIST)
+    if os.path.exists(path):
+        return
+    root = _new_document('capabilitylist')
+    for filename, capability in ((RESOURCE_LIST, 'resourcelist'), (CHANGE_LIST, 'changelist')):
+        url = _url_element(root, _document_url(filename))
+        etree.SubElement(url, nsrs('md'), capability=capability)
+    _write(root, path)
+
+
+def is_listed(package_id):
+    '''Whether a dataset is public as far as the change log knows: its
+    latest change not yet published, or else its presence in the published
+    resource list.
+    '''
+    change = Session.query(ResourceChange.change). \
+        filter(ResourceChange.package_id == package_id). \
+        filter(ResourceChange.published == False). \
+        order_by(ResourceChange.id.desc()).first()
+    if change:
+        return change[0] != 'deleted'
+    return Resource.get(package_id) is not None
+
+
+def record_change(package_id, public, lastmod=None):
+    '''Log a change of a dataset which is or was public for
+    :func:`publish`: 'created' when it becomes public, 'updated' while it
+    stays public and 'deleted' when it's deleted or made private. Changes
+    of datasets which never were public aren't logged. Doesn't commit, the
+    change is saved with the dataset.
+
+    :param package_id: id of the dataset
+    :param public: whether the dataset is public after the change
+    :param lastmod: modification time of the dataset, defaults to now
+    :type lastmod: datetime.datetime
+    :returns: the logged change, or None
+    '''
+    listed = is_listed(package_id)
+    if public:
+        change = 'updated' if listed else 'created'
+    elif listed:
+        change = 'deleted'
+    else:
+        return None
+    now = datetime.datetime.utcnow()
+    Session.add(ResourceChange(package_id=package_id, change=change, lastmod=lastmod or now, datetime=now))
+    return change
+
+
+def _public_packages():
+    return Session.query(Package.id, Package.metadata_modified). \
+        filter(Package.type == 'dataset'). \
+        filter(Package.state == 'active').filter(Package.private != True)
+
+
+def setup():
+    '''Create the tables, and fill the published resources from the
+    public datasets if nothing has been published yet, so that changes are
+    logged against the current visibility of the datasets.
+    '''
+    oaipmh_model.setup()
+    if not get_public_path():
+        return
+    with _locked() as directory:
+        if os.path.exists(os.path.join(directory, RESOURCE_LIST)) or Session.query(Resource).first():
+            return
+        now = datetime.datetime.utcnow()
+        resources = [{'package_id': package_id, 'lastmod': modified or now}
+                     for package_id, modified in _public_packages()]
+        if resources:
+            Session.execute(oaipmh_model.resource_table.insert(), resources)
+        Session.query(ResourceChange).update({'published': True}, synchronize_session=False)
+        Session.commit()
+        log.info('ResourceSync: filled the resource list from the public datasets')
+
+
+def _apply_changes():
+    '''Apply the changes logged since the last publication to the
+    published resources.
+
+    :returns: the number of applied changes
+    '''
+    changes = Session.query(ResourceChange).filter(ResourceChange.published == False). \
+        order_by(ResourceChange.id).all()
+    # Only the latest change of a dataset matters
+    latest = dict((change.package_id, change) for change in changes)
+    table = oaipmh_model.resource_table
+    if latest:
+        Session.execute(table.delete().where(table.c.package_id.in_(list(latest.keys()))))
+        resources = [{'package_id': change.package_id, 'lastmod': change.lastmod}
+                     for change in latest.values() if change.change != 'deleted']
+        if resources:
+            Session.execute(table.insert(), resources)
+    for change in changes:
+        change.published = True
+    return len(changes)
+
+
+def _write_resource_list(directory, now):
+    resources = _new_document('resourcelist', at=_w3c(now))
+    rows = Session.query(Resource.package_id, Resource.lastmod).order_by(Resource.package_id)
+    for package_id, lastmod in rows.yield_per(1000):
+        _url_element(resources, _record_url(package_id), _w3c(lastmod))
+    _write(resources, os.path.join(directory, RESOURCE_LIST))
+    return len(resources.findall(nssm('url')))
+
+
+def _write_change_list(directory):
+    '''Write the latest changes of the log and drop the older ones.'''
+    size = int(config.get('ckanext.oaipmh.resourcesync.changelist_size', 10000))
+    oldest_kept = Session.query(ResourceChange.id).order_by(ResourceChange.id.desc()). \
+        offset(size - 1).limit(1).scalar()
+    if oldest_kept is not None:
+        Session.query(ResourceChange).filter(ResourceChange.id < oldest_kept). \
+            delete(synchronize_session=False)
+    changes = _new_document('changelist')
+    first = None
+    for change in Session.query(ResourceChange).order_by(ResourceChange.id).yield_per(1000):
+        url = _url_element(changes, _record_url(change.package_id), _w3c(change.lastmod))
+        etree.SubElement(url, nsrs('md'), change=change.change, datetime=_w3c(change.datetime))
+        first = first or change.datetime
+    if first:
+        changes.find(nsrs('md')).set('from', _w3c(first))
+    _write(changes, os.path.join(directory, CHANGE_LIST))
+    return len(changes.findall(nssm('url')))
+
+
+def publish():
+    '''Apply the changes logged since the last publication to the
+    resource list and write the capability, resource and change lists. Run
+    periodically out of band, e.g. with ``paster oaipmh resourcesync``,
+    rather than on every write. The resource and change lists are only
+    rewritten if there are new changes.
+
+    :returns: the number of resources and changes written, None if there
+        were no new changes
+    '''
+    now = datetime.datetime.utcnow()
+    with _locked() as directory:
+        _write_capability_list(directory)
+        applied = _apply_changes()
+        if not applied and os.path.exists(os.path.join(directory, RESOURCE_LIST)) and \
+                os.path.exists(os.path.join(directory, CHANGE_LIST)):
+            Session.rollback()
+            return None
+        resources = _write_resource_list(directory, now)
+        changes = _write_change_list(directory)
+        Session.commit()
+    log.info('ResourceSync: applied %d changes, published %d resources and %d changes', applied, resources, changes)
+    return resources, changes
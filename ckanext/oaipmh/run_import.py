@@ -3,23 +3,24 @@
 
 import logging
 
-import oaipmh.client
-
 import importformats
+from transport import HTTPTransport, TransportClient
 
 logging.basicConfig(level=logging.DEBUG)
 
+transport = HTTPTransport()
+
 
 def test_fetch(url, record_id, fmt):
     registry = importformats.create_metadata_registry()
-    client = oaipmh.client.Client(url, registry)
+    client = TransportClient(url, registry, transport=transport)
     record = client.getRecord(identifier=record_id, metadataPrefix=fmt)
     return record
 
 
 def test_list(url):
     registry = importformats.create_metadata_registry()
-    client = oaipmh.client.Client(url, registry)
+    client = TransportClient(url, registry, transport=transport)
     return (header.identifier() for header in
             client.listIdentifiers(metadataPrefix='oai_dc'))
 
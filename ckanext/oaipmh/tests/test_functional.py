@@ -6,6 +6,7 @@ Functional tests for OAI-PMH harvester.
 """
 
 import datetime
+import zlib
 from unittest import TestCase
 
 import oaipmh.client
@@ -14,6 +15,7 @@ import random
 
 from ckan.model import Group
 from ckanext.harvest import model as harvest_model
+import ckanext.oaipmh.model as oaipmh_model
 from ckanext.oaipmh import importformats
 from ckanext.oaipmh.harvester import OAIPMHHarvester
 import ckanext.kata.model as kata_model
@@ -23,13 +25,19 @@ from ckan.tests import WsgiAppCase
 from ckan.lib.helpers import url_for
 
 import lxml.etree
+import rdflib
+from rdflib.compare import isomorphic
 from ckan.logic import get_action
 from ckan import model
 from ckanext.kata.tests.test_fixtures.unflattened import TEST_DATADICT
 
+from contextlib import contextmanager
 from copy import deepcopy
 import os
 
+from sqlalchemy import event
+
+from pylons import config
 from pylons.util import AttribSafeContextObj, PylonsContext, pylons
 
 
@@ -52,6 +60,7 @@ class TestReadingFixtures(TestCase):
         '''
         model.repo.rebuild_db()
         harvest_model.setup()
+        oaipmh_model.setup()
         kata_model.setup()
         cls.harvester = OAIPMHHarvester()
 
@@ -118,6 +127,7 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
         '''
         model.repo.rebuild_db()
         harvest_model.setup()
+        oaipmh_model.setup()
         kata_model.setup()
 
         # The Pylons globals are not available outside a request. This is a hack to provide context object.
@@ -273,6 +283,134 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
 
         self.assertFalse(fail, "No headers (packages) received")
 
+    def test_conditional_get(self):
+        model.User(name="test_conditional", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_conditional'}, {'name': 'test-organization-conditional', 'title': "Test organization conditional"})
+        package_data = deepcopy(TEST_DATADICT)
+        package_data['owner_org'] = organization['name']
+        package_data['private'] = False
+        for pid in package_data.get('pids', []):
+            pid['id'] = utils.generate_pid()
+        package = get_action('package_create')({'user': 'test_conditional'}, package_data)
+
+        url = url_for('/oai')
+        params = {'verb': 'GetRecord', 'identifier': package['id'], 'metadataPrefix': 'oai_dc'}
+        result = self.app.get(url, params)
+        etag = result.headers['ETag']
+        last_modified = result.headers['Last-Modified']
+
+        self.app.get(url, params, headers={'If-None-Match': etag}, status=304)
+        self.app.get(url, params, headers={'If-Modified-Since': last_modified}, status=304)
+        self.app.get(url, dict(params, metadataPrefix='rdf'), headers={'If-None-Match': etag}, status=200)
+
+        list_params = {'verb': 'ListRecords', 'set': organization['name'], 'metadataPrefix': 'oai_dc'}
+        result = self.app.get(url, list_params)
+        list_etag = result.headers['ETag']
+        # A page is only validated by its ETag
+        self.assertFalse('Last-Modified' in result.headers)
+        self.app.get(url, list_params, headers={'If-None-Match': list_etag}, status=304)
+        self.app.get(url, list_params, headers={'If-Modified-Since': last_modified}, status=200)
+
+        get_action('package_patch')({'user': 'test_conditional'}, {'id': package['id'], 'notes': 'Changed'})
+        self.app.get(url, params, headers={'If-None-Match': etag}, status=200)
+        # The validators of a page describe the records on it
+        result = self.app.get(url, list_params, headers={'If-None-Match': list_etag}, status=200)
+        self.assertTrue('Changed' in result.body)
+        list_etag = result.headers['ETag']
+
+        # A dataset leaving the page changes its ETag, and the page isn't
+        # served from the cache
+        get_action('package_patch')({'user': 'test_conditional'}, {'id': package['id'], 'private': True})
+        result = self.app.get(url, list_params, headers={'If-None-Match': list_etag}, status=200)
+        self.assertFalse(package['id'] in result.body)
+
+        get_action('organization_delete')({'user': 'test_conditional'}, {'id': organization['id']})
+
+    def test_list_records_rdf(self):
+        model.User(name="test_render", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_render'}, {'name': 'test-organization-render', 'title': "Test organization render"})
+        package_ids = []
+        for i in range(4):
+            package_data = deepcopy(TEST_DATADICT)
+            package_data['owner_org'] = organization['name']
+            package_data['private'] = False
+            package_data['name'] = 'test-render-%d' % i
+            for pid in package_data.get('pids', []):
+                pid['id'] = utils.generate_pid()
+            package_ids.append(get_action('package_create')({'user': 'test_render'}, package_data)['id'])
+
+        url = url_for('/oai')
+        result = self.app.get(url, {'verb': 'ListRecords', 'set': organization['name'], 'metadataPrefix': 'rdf'})
+        records = self._get_results(lxml.etree.fromstring(result.body), "//o:record")
+        self.assertEquals(len(records), len(package_ids))
+        for record in records:
+            identifier = record.xpath("string(o:header/o:identifier)", namespaces=self._namespaces)
+            metadata = lxml.etree.tostring(self._get_single_result(record, 'o:metadata'))
+            # The records of a page share a serializer, but the graph of a
+            # record describes its own dataset only
+            self.assertTrue(identifier in metadata)
+            for other in package_ids:
+                if other != identifier:
+                    self.assertFalse(other in metadata, "Record of {i} mentions {o}".format(i=identifier, o=other))
+
+        get_action('organization_delete')({'user': 'test_render'}, {'id': organization['id']})
+
+    def test_list_records_match_get_record(self):
+        '''ListRecords takes the dataset dicts from the search index for a
+        whole page, GetRecord from package_show. Both must render the same
+        records.
+        '''
+        model.User(name="test_parity", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_parity'}, {'name': 'test-organization-parity', 'title': "Test organization parity"})
+        for i in range(3):
+            package_data = deepcopy(TEST_DATADICT)
+            package_data['owner_org'] = organization['name']
+            package_data['private'] = False
+            package_data['name'] = 'test-parity-%d' % i
+            for pid in package_data.get('pids', []):
+                pid['id'] = utils.generate_pid()
+            get_action('package_create')({'user': 'test_parity'}, package_data)
+
+        url = url_for('/oai')
+        for prefix in ('oai_dc', 'rdf'):
+            result = self.app.get(url, {'verb': 'ListRecords', 'set': organization['name'], 'metadataPrefix': prefix})
+            records = self._get_results(lxml.etree.fromstring(result.body), "//o:record")
+            self.assertEquals(len(records), 3)
+            for record in records:
+                identifier = record.xpath("string(o:header/o:identifier)", namespaces=self._namespaces)
+                result = self.app.get(url, {'verb': 'GetRecord', 'identifier': identifier, 'metadataPrefix': prefix})
+                expected = self._get_single_result(lxml.etree.fromstring(result.body), "//o:record")
+                if prefix == 'rdf':
+                    # Blank nodes are named anew in every serialization
+                    graphs = [rdflib.Graph().parse(data=lxml.etree.tostring(self._get_single_result(r, 'o:metadata/*')), format='xml')
+                              for r in (record, expected)]
+                    self.assertTrue(isomorphic(*graphs), "Records of {i} differ".format(i=identifier))
+                else:
+                    self.assertEquals(lxml.etree.tostring(record), lxml.etree.tostring(expected))
+
+        get_action('organization_delete')({'user': 'test_parity'}, {'id': organization['id']})
+
+    def test_compression(self):
+        url = url_for('/oai')
+        result = self.app.get(url, {'verb': 'Identify'})
+        self.assertFalse('Content-Encoding' in result.headers)
+        root = lxml.etree.fromstring(result.body)
+        compression = [element.text for element in self._get_results(root, "//o:compression")]
+        self.assertEquals(['identity', 'gzip', 'deflate'], compression)
+
+        result = self.app.get(url, {'verb': 'Identify'}, headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals('gzip', result.headers['Content-Encoding'])
+        root = lxml.etree.fromstring(zlib.decompress(result.body, 16 + zlib.MAX_WBITS))
+        self._get_single_result(root, "//o:Identify")
+
+        result = self.app.get(url, {'verb': 'Identify'}, headers={'Accept-Encoding': 'deflate'})
+        self.assertEquals('deflate', result.headers['Content-Encoding'])
+        lxml.etree.fromstring(zlib.decompress(result.body))
+
+        result = self.app.get(url, {'verb': 'Identify'}, headers={'Accept-Encoding': 'identity'})
+        self.assertFalse('Content-Encoding' in result.headers)
+        lxml.etree.fromstring(result.body)
+
     def test_private_record(self):
         '''
         Test that private packages are not listed but public packages are
@@ -320,3 +458,153 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
             self.assertTrue(identifier == package2['id'])
 
         get_action('organization_delete')({'user': 'privateuser'}, {'id': organization['id']})
+
+
+class TestOaipmhServerQueryCount(WsgiAppCase, TestCase):
+    """ Guard the OAI-PMH server against per-record (N+1) queries.
+
+    Every verb is run against a small and a large fixture with the same
+    resumption batch size. The number of SQL statements must not grow with
+    the number of datasets on the page. Every dataset has two revisions, so
+    that a from/until window matching several revisions of a dataset is
+    covered too.
+    """
+
+    SMALL = 2
+    LARGE = 8
+    ORGANIZATION = 'query-count-organization'
+
+    _namespaces = {'o': 'http://www.openarchives.org/OAI/2.0/'}
+
+    @classmethod
+    def setup_class(cls):
+        c = AttribSafeContextObj()
+        py_obj = PylonsContext()
+        py_obj.tmpl_context = c
+        pylons.tmpl_context._push_object(c)
+        # Measure the server, not the response cache
+        cls.cache_expire = config.get('ckanext.oaipmh.cache.expire')
+        config['ckanext.oaipmh.cache.expire'] = '0'
+
+    @classmethod
+    def teardown_class(cls):
+        if cls.cache_expire is None:
+            del config['ckanext.oaipmh.cache.expire']
+        else:
+            config['ckanext.oaipmh.cache.expire'] = cls.cache_expire
+
+    def setUp(self):
+        model.repo.rebuild_db()
+        harvest_model.setup()
+        oaipmh_model.setup()
+        kata_model.setup()
+        model.User(name="test_query_count", sysadmin=True).save()
+        get_action('organization_create')({'user': 'test_query_count'},
+                                          {'name': self.ORGANIZATION, 'title': "Query count organization"})
+        self.package_ids = []
+
+    def tearDown(self):
+        model.repo.rebuild_db()
+
+    @contextmanager
+    def _count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(model.meta.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', before_cursor_execute)
+
+    def _create_packages(self, count):
+        for _ in range(count):
+            data = deepcopy(TEST_DATADICT)
+            data['owner_org'] = self.ORGANIZATION
+            data['private'] = False
+            data['name'] = 'query-count-package-%d' % len(self.package_ids)
+            for pid in data.get('pids', []):
+                pid['id'] = utils.generate_pid()
+            package = get_action('package_create')({'user': 'test_query_count'}, data)
+            get_action('package_patch')({'user': 'test_query_count'}, {'id': package['id'], 'notes': 'Revised'})
+            self.package_ids.append(package['id'])
+
+    def _get(self, params):
+        result = self.app.get(url_for('/oai'), params)
+        return lxml.etree.fromstring(result.body)
+
+    def _assert_headers(self, params):
+        root = self._get(params)
+        identifiers = [header.xpath("string(o:identifier)", namespaces=self._namespaces)
+                       for header in root.xpath("//o:header", namespaces=self._namespaces)]
+        self.assertEquals(len(identifiers), len(self.package_ids))
+        self.assertEquals(sorted(set(identifiers)), sorted(self.package_ids))
+
+    def _query_count(self, params):
+        # Warm up caches so that only the request itself is measured
+        self._get(params)
+        with self._count_queries() as statements:
+            self._get(params)
+        return len(statements)
+
+    def _query_counts(self, params):
+        self._create_packages(self.SMALL)
+        small = self._query_count(params)
+        self._create_packages(self.LARGE - self.SMALL)
+        large = self._query_count(params)
+        return small, large
+
+    def _assert_constant(self, params):
+        small, large = self._query_counts(params)
+        self.assertEquals(small, large, "Query count grows with page size for {p}: {s} -> {l}".format(
+            p=params, s=small, l=large))
+
+    def _window(self):
+        today = datetime.datetime.utcnow()
+        return {'from': (today - datetime.timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'until': (today + datetime.timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+    def test_identify(self):
+        self._assert_constant({'verb': 'Identify'})
+
+    def test_list_sets(self):
+        self._assert_constant({'verb': 'ListSets'})
+
+    def test_list_metadata_formats(self):
+        self._assert_constant({'verb': 'ListMetadataFormats'})
+
+    def test_get_record(self):
+        self._create_packages(self.LARGE)
+        for prefix in ('oai_dc', 'rdf'):
+            first = self._query_count({'verb': 'GetRecord', 'identifier': self.package_ids[0], 'metadataPrefix': prefix})
+            last = self._query_count({'verb': 'GetRecord', 'identifier': self.package_ids[-1], 'metadataPrefix': prefix})
+            self.assertEquals(first, last)
+
+    def test_list_identifiers(self):
+        self._assert_constant({'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'})
+
+    def test_list_identifiers_set(self):
+        self._assert_constant({'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc', 'set': self.ORGANIZATION})
+
+    def test_list_identifiers_window(self):
+        params = {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'}
+        params.update(self._window())
+        self._assert_constant(params)
+        self._assert_headers(params)
+
+    def test_list_records(self):
+        self._assert_constant({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'})
+
+    def test_list_records_rdf(self):
+        self._assert_constant({'verb': 'ListRecords', 'metadataPrefix': 'rdf'})
+
+    def test_list_records_set(self):
+        self._assert_constant({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'set': self.ORGANIZATION})
+
+    def test_list_records_window(self):
+        params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}
+        params.update(self._window())
+        self._assert_constant(params)
+        self._assert_headers(params)
@@ -5,11 +5,22 @@
 Unit tests for OAI-PMH harvester.
 """
 import copy
-from unittest import TestCase
+import datetime
+import http.server
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import zlib
+from contextlib import contextmanager
+from unittest import TestCase, mock
 
 import testfixtures
+import oaipmh.client
 import bs4
 from lxml import etree
+import pylons
 from pylons import config
 
 import ckan
@@ -19,10 +30,19 @@ from ckanext.oaipmh.cmdi import CMDIHarvester
 from ckanext.oaipmh.cmdi_reader import CmdiReader
 from ckanext.oaipmh.harvester import OAIPMHHarvester
 import ckanext.harvest.model as harvest_model
+import ckanext.oaipmh.model as oaipmh_model
 import ckanext.kata.model as kata_model
 from ckanext.oaipmh.ida import IdaHarvester
 from ckanext.oaipmh.importformats import create_metadata_registry
 import ckanext.oaipmh.oai_dc_reader as dcr
+from ckanext.oaipmh import cache, controller, indexing, pids, resourcesync, workers
+from ckanext.oaipmh.fetcher import AdaptiveLimiter
+from ckanext.oaipmh.indexing import DeferredIndexing
+from ckanext.oaipmh.oaipmh_server import CKANServer
+from ckanext.oaipmh.partitions import date_windows, list_partitions
+from ckanext.oaipmh.policy import RequestPolicy
+from ckanext.oaipmh.transport import decompress, HTTPTransport, TransportClient
+from ckanext.oaipmh.utils import normalize_oai_args, SingleFlight
 from ckanext.oaipmh.oai_dc_reader import dc_metadata_reader
 import os
 from ckan import model
@@ -57,7 +77,8 @@ class _FakeHarvestSource():
 
 
 class _FakeHarvestJob():
-    def __init__(self, source):
+    def __init__(self, source, identification='test_job'):
+        self.id = identification
         self.source = source
 
 
@@ -67,9 +88,12 @@ class _FakeHarvestObject():
         self.id = identification
         self.guid = self.id
         self.source = _FakeHarvestSource(config, source_url)
-        self.harvest_source_id = None
+        self.harvest_source_id = 'test_source'
         self.job = _FakeHarvestJob(self.source)
         self.report_status = None
+        self.package_id = None
+        self.current = False
+        self.extras = []
 
     def add(self):
         pass
@@ -79,17 +103,72 @@ class _FakeHarvestObject():
 
 
 class _FakeIdentifier():
-    def __init__(self, identifier):
+    def __init__(self, identifier, datestamp=None):
         self._identifier = identifier
+        self._datestamp = datestamp
 
     def identifier(self):
         return self._identifier
 
+    def datestamp(self):
+        return self._datestamp
+
 
 class _FakeClient():
     def listIdentifiers(self, metadataPrefix):
         return [_FakeIdentifier('oai:kielipankki.fi:sha3a880')]
 
+
+class _FakeHeaderClient():
+    def __init__(self, headers):
+        self.headers = headers
+        self.requests = []
+
+    def listIdentifiers(self, **kwargs):
+        self.requests.append(kwargs)
+        return [_FakeIdentifier(identifier, datestamp) for identifier, datestamp in self.headers]
+
+
+class _FakeHeader(_FakeIdentifier):
+    def isDeleted(self):
+        return False
+
+
+class _FakeMetadata():
+    def __init__(self, content):
+        self._content = content
+
+    def getMap(self):
+        return self._content
+
+
+class _FakeRecordClient():
+    def listRecords(self, metadataPrefix):
+        return [(_FakeHeader('oai:kielipankki.fi:sha3a880'), _FakeMetadata({'unified': {'title': 'Bulk'}}), None)]
+
+    def getRecord(self, **kwargs):
+        raise AssertionError('Records should have been fetched in the gather stage')
+
+class _FakePagingClient(oaipmh.client.BaseClient):
+    ''' Serves ListIdentifiers pages of two identifiers, failing once before `fail_at` '''
+    def __init__(self, pages, fail_at=None):
+        self.pages = pages
+        self.fail_at = fail_at
+        self.requests = []
+
+    def makeRequestErrorHandling(self, **kw):
+        self.requests.append(kw)
+        page = int(kw['resumptionToken']) if 'resumptionToken' in kw else 0
+        if page == self.fail_at:
+            self.fail_at = None
+            raise IOError('Connection reset')
+        return page
+
+    def buildIdentifiers(self, namespaces, page):
+        token = str(page + 1) if page + 1 < len(self.pages) else None
+        return [_FakeIdentifier(identifier) for identifier in self.pages[page]], token
+
+
 class TestOAIPMHHarvester(TestCase):
 
     @classmethod
@@ -99,6 +178,7 @@ class TestOAIPMHHarvester(TestCase):
         '''
         ckan.model.repo.rebuild_db()
         harvest_model.setup()
+        oaipmh_model.setup()
         kata_model.setup()
         cls.harvester = OAIPMHHarvester()
 
@@ -123,6 +203,26 @@ class TestOAIPMHHarvester(TestCase):
         harvest_object = _FakeHarvestObject(None, "test_fetch_id", {'type': 'ida'}, url)
         self.assertRaises(Exception, self.harvester.fetch_stage, harvest_object)
 
+    def test_harvest_context(self):
+        url = "file://%s" % _get_fixture('ida.xml')
+        first = _FakeHarvestObject(None, "first", {'type': 'ida'}, url)
+        second = _FakeHarvestObject(None, "second", {'type': 'ida'}, url)
+        context = self.harvester.harvest_context(first)
+        self.assertTrue(self.harvester.harvest_context(second) is context)
+        self.assertTrue(context.client is context.client)
+        self.assertEquals(self.harvester._get_configuration(second), {'type': 'ida'})
+
+        created = []
+        context.schema('create', lambda: created.append(1) or {'id': []})['id'].append('changed')
+        self.assertEquals(context.schema('create', lambda: created.append(1)), {'id': []})
+        self.assertEquals(len(created), 1)
+
+        changed = _FakeHarvestObject(None, "changed", {'type': 'default'}, url)
+        self.assertFalse(self.harvester.harvest_context(changed) is context)
+        next_job = _FakeHarvestObject(None, "next", {'type': 'ida'}, url)
+        next_job.job = _FakeHarvestJob(next_job.source, 'next_job')
+        self.assertFalse(self.harvester.harvest_context(next_job) is context)
+
     def test_import_stage(self):
         assert not self.harvester.import_stage(None)
 
@@ -142,6 +242,7 @@ class TestOAIPMHHarvester(TestCase):
         harvest_object = _FakeHarvestObject(json.dumps(metadata.getMap()), "test_id", config)
 
         self.harvester.import_stage(harvest_object)
+        return harvest_object
 
     def test_import_stage_data(self):
         for xml_path, ida in ('ida.xml', True), ('helda.xml', False):
@@ -181,6 +282,145 @@ class TestOAIPMHHarvester(TestCase):
         for key, value in expected:
             self.assertEquals(package.extras.get(key), value)
 
+    def test_import_stage_unchanged(self):
+        self._run_import('helda.xml', False)
+        package = _get_single_package()
+        modified = package.metadata_modified
+
+        harvest_object = self._run_import('helda.xml', False)
+        self.assertEquals(harvest_object.package_id, package.id)
+        self.assertTrue(harvest_object.current)
+        self.assertEquals(_get_single_package().metadata_modified, modified)
+
+        self._run_import('helda.xml', False, {'type': 'default', 'force_update': True})
+        self.assertNotEquals(_get_single_package().metadata_modified, modified)
+
+    def test_batch_import(self):
+        model.User(name='harvest', sysadmin=True).save()
+        get_action('organization_create')({'user': 'harvest'}, {'name': 'test'})
+        source = HarvestSource(url="http://localhost/test_batch", type="oai-pmh", config='{"batch_import": true}')
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+
+        metadata = dc_metadata_reader('default')(_get_record('helda.xml'))
+        metadata['unified']['owner_org'] = "test"
+        valid = HarvestObject(guid='valid', job=job, content=json.dumps(metadata.getMap()))
+        valid.save()
+        invalid = HarvestObject(guid='invalid', job=job, content=json.dumps({'unified': {'owner_org': 'test'}}))
+        invalid.save()
+
+        # The gathered objects are left waiting for the batch import
+        gathered = HarvestJob(source=source)
+        gathered.save()
+        client = _FakeHeaderClient([('waiting', datetime.datetime(2016, 1, 1))])
+        self.assertEquals(self.harvester.populate_harvest_job(gathered, set(), {'batch_import': True}, client), [])
+        waiting = model.Session.query(HarvestObject).filter(HarvestObject.harvest_job_id == gathered.id).one()
+        self.assertEquals(waiting.state, 'WAITING')
+
+        indexer = _FakeIndexer()
+        with DeferredIndexing(indexer) as deferred:
+            self.assertEquals(self.harvester.import_objects([valid, invalid], indexing=deferred), 1)
+            self.assertFalse(ckan.plugins.plugin_loaded('synchronous_search'))
+            self.assertEquals(indexer.batches, [])
+        self.assertEquals((valid.state, invalid.state), ('COMPLETE', 'ERROR'))
+        self.assertEquals(_get_single_package().id, valid.package_id)
+        self.assertEquals(len(indexer.batches), 1)
+        self.assertTrue(valid.package_id in indexer.batches[0])
+
+    def test_defer_indexing(self):
+        with mock.patch.object(indexing.SearchIndexer, 'index') as index:
+            harvest_object = self._run_import('helda.xml', False, {'type': 'default', 'defer_indexing': True})
+        package = _get_single_package()
+        # The fake job has no other objects, so its indexing ends with the import
+        self.assertEquals(harvest_object.package_id, package.id)
+        self.assertTrue(package.id in index.call_args[0][0])
+        self.assertTrue(self.harvester.harvest_context(harvest_object).indexing is None)
+        self.assertTrue(ckan.plugins.plugin_loaded('synchronous_search'))
+
+    def test_pid_index(self):
+        self._run_import('helda.xml', False)
+        package = _get_single_package()
+        package_dict = get_action('package_show')({'model': model, 'session': model.Session, 'user': 'harvest'}, {'id': package.id})
+        primary_pid = utils.get_primary_pid(package_dict)
+
+        self.assertEquals(pids.get_package_id_by_pid(primary_pid, 'primary'), package.id)
+        self.assertEquals(pids.get_package_id_by_primary_pid(primary_pid), package.id)
+        self.assertEquals(pids.get_package_id_by_pid(primary_pid, 'relation'), None)
+
+        indexed = model.Session.query(oaipmh_model.PackagePid).count()
+        self.assertEquals(pids.rebuild(), indexed)
+        self.assertEquals(pids.get_package_id_by_pid(primary_pid, 'primary'), package.id)
+
+        # Without the plugin, datasets missing from the table are found in the extras
+        model.Session.query(oaipmh_model.PackagePid).delete()
+        model.Session.commit()
+        with mock.patch.object(pids, '_fall_back', return_value=True):
+            self.assertEquals(pids.get_package_id_by_primary_pid(primary_pid), package.id)
+            self.assertEquals(pids.get_package_ids_by_primary_pids([primary_pid]), {primary_pid: package.id})
+        pids.rebuild()
+
+        package.state = 'deleted'
+        model.Session.commit()
+        self.assertEquals(pids.get_package_id_by_primary_pid(primary_pid), None)
+        with mock.patch.object(pids, '_fall_back', return_value=True):
+            self.assertEquals(pids.get_package_id_by_primary_pid(primary_pid), None)
+
+    def test_gather_changed(self):
+        source = HarvestSource(url="http://localhost/test_changed", type="oai-pmh")
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        package = model.Package(name='test-changed')
+        package.save()
+        old, new = datetime.datetime(2016, 1, 1), datetime.datetime(2016, 2, 1)
+        for guid in 'a', 'b':
+            oaipmh_model.HarvestedRecord(harvest_source_id=source.id, guid=guid, datestamp=old,
+                                         content_hash=u'hash', package_id=package.id).save()
+
+        client = _FakeHeaderClient([('a', old), ('b', new), ('c', new)])
+        object_ids = self.harvester.populate_harvest_job(job, set(), {}, client)
+
+        harvest_objects = [HarvestObject.get(object_id) for object_id in object_ids]
+        self.assertEquals([obj.guid for obj in harvest_objects], ['b', 'c'])
+        self.assertEquals(self.harvester._remote_datestamp(harvest_objects[0]), new)
+
+    def test_gather_watermarks(self):
+        source = HarvestSource(url="http://localhost/test_watermarks", type="oai-pmh")
+        source.save()
+        old, new = datetime.datetime(2016, 1, 1), datetime.datetime(2016, 2, 1)
+
+        client = _FakeHeaderClient([('a', old), ('b', new)])
+        latest = {}
+        list(self.harvester.get_headers(['set1'], {}, {'set1': old}, client, latest=latest))
+        self.assertEquals(client.requests, [{'metadataPrefix': 'oai_dc', 'set': 'set1', 'from_': old}])
+        self.assertEquals(latest, {'set1': new})
+
+        self.harvester._save_watermarks(source.id, latest)
+        self.harvester._save_watermarks(source.id, {'set1': old})
+        self.assertEquals(self.harvester._watermarks(source.id, client), {'set1': new})
+
+    def test_gather_checkpoint(self):
+        source = HarvestSource(url="http://localhost/test_checkpoint", type="oai-pmh")
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        pages = [['a', 'b'], ['c', 'd'], ['e']]
+
+        client = _FakePagingClient(pages, fail_at=2)
+        self.assertRaises(IOError, list, self.harvester.get_package_ids(None, {}, None, client, job))
+        waiting = HarvestObject(guid='a', job=job)
+        waiting.save()
+
+        resumed = HarvestJob(source=source)
+        resumed.save()
+        client = _FakePagingClient(pages)
+        identifiers = list(self.harvester.get_package_ids(None, {}, None, client, resumed))
+        self.assertEquals(identifiers, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEquals(client.requests, [{'verb': 'ListIdentifiers', 'resumptionToken': '2'}])
+        # The objects of the interrupted gather are never imported
+        self.assertEquals(HarvestObject.get(waiting.id).state, 'ERROR')
+
     def test_validate_config_valid(self):
         config = '{"from": "2014-03-03", "limit": 5}'
 
@@ -214,6 +454,7 @@ class TestIdaHarvester(TestCase):
     def setup_class(cls):
         ''' Setup database and variables '''
         harvest_model.setup()
+        oaipmh_model.setup()
         kata_model.setup()
         cls.harvester = IdaHarvester()
 
@@ -240,6 +481,7 @@ class TestCMDIHarvester(TestCase):
     def setup_class(cls):
         ''' Setup database and variables '''
         harvest_model.setup()
+        oaipmh_model.setup()
         kata_model.setup()
         cls.harvester = CMDIHarvester()
 
@@ -289,6 +531,22 @@ class TestCMDIHarvester(TestCase):
         self.harvester.client = _FakeClient()
         self.harvester.gather_stage(job)
 
+    def test_gather_bulk(self):
+        source = HarvestSource(url="http://localhost/test_cmdi_bulk", type="cmdi", config='{"bulk": true}')
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        self.harvester.client = _FakeRecordClient()
+        try:
+            object_ids = self.harvester.gather_stage(job)
+        finally:
+            self.harvester.client = None
+
+        assert len(object_ids) == 1, object_ids
+        harvest_object = HarvestObject.get(object_ids[0])
+        self.assertEquals(json.loads(harvest_object.content), {'unified': {'title': 'Bulk'}})
+        assert self.harvester.fetch_stage(harvest_object)
+
     def test_import(self):
         source = HarvestSource(url="http://localhost/test_cmdi", type="cmdi")
         source.save()
@@ -610,3 +868,578 @@ class TestImportFormats(TestCase):
 
         assert reg
         assert reg.hasReader('oai_dc')
+
+
+class TestResourceSync(TestCase):
+
+    _namespaces = {'sm': resourcesync.NS_SITEMAP, 'rs': resourcesync.NS_RS}
+
+    @classmethod
+    def setup_class(cls):
+        model.repo.rebuild_db()
+        oaipmh_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setUp(self):
+        self.public_path = tempfile.mkdtemp()
+        config['ckanext.oaipmh.resourcesync.public_path'] = self.public_path
+        model.Session.query(oaipmh_model.ResourceChange).delete()
+        model.Session.query(oaipmh_model.Resource).delete()
+        model.Session.commit()
+
+    def tearDown(self):
+        del config['ckanext.oaipmh.resourcesync.public_path']
+        shutil.rmtree(self.public_path)
+
+    def _parse(self, filename):
+        return etree.parse(os.path.join(self.public_path, resourcesync.DIRECTORY, filename))
+
+    def _locs(self, filename):
+        return self._parse(filename).xpath('//sm:url/sm:loc/text()', namespaces=self._namespaces)
+
+    def test_publish(self):
+        package = model.Package(name='resourcesync-1')
+        package.save()
+        assert resourcesync.record_change(package.id, True) == 'created'
+        assert resourcesync.record_change('package-2', True) == 'created'
+        assert resourcesync.record_change(package.id, True) == 'updated'
+        assert resourcesync.record_change('package-2', False) == 'deleted'
+        # A dataset which never was public isn't logged
+        assert resourcesync.record_change('package-3', False) is None
+        model.Session.commit()
+
+        # Nothing is written until the documents are published
+        assert not os.path.exists(os.path.join(self.public_path, resourcesync.DIRECTORY))
+        assert resourcesync.publish() == (1, 4)
+
+        capabilities = self._parse(resourcesync.CAPABILITY_LIST)
+        assert capabilities.xpath('//sm:url/rs:md/@capability', namespaces=self._namespaces) == \
+            ['resourcelist', 'changelist']
+
+        locs = self._locs(resourcesync.RESOURCE_LIST)
+        assert len(locs) == 1, locs
+        assert locs[0].endswith('identifier=%s' % package.id), locs
+
+        changes = self._parse(resourcesync.CHANGE_LIST)
+        assert changes.xpath('//sm:url/rs:md/@change', namespaces=self._namespaces) == \
+            ['created', 'updated', 'updated', 'deleted']
+
+        # The documents are only rewritten when there are new changes
+        assert resourcesync.publish() is None
+
+        # New changes are applied to the published resource list
+        assert resourcesync.record_change(package.id, False) == 'deleted'
+        assert resourcesync.record_change('package-2', True) == 'created'
+        model.Session.commit()
+        assert resourcesync.publish() == (1, 6)
+        locs = self._locs(resourcesync.RESOURCE_LIST)
+        assert len(locs) == 1, locs
+        assert locs[0].endswith('identifier=package-2'), locs
+
+    def test_setup(self):
+        package = model.Package(name='resourcesync-setup')
+        package.save()
+        private = model.Package(name='resourcesync-setup-private', private=True)
+        private.save()
+        resourcesync.setup()
+        assert resourcesync.is_listed(package.id)
+        assert not resourcesync.is_listed(private.id)
+        # Changes are logged against the visibility of the existing datasets
+        assert resourcesync.record_change(package.id, True) == 'updated'
+        assert resourcesync.record_change(private.id, False) is None
+        model.Session.rollback()
+
+    def test_changelist_size(self):
+        for i in range(5):
+            resourcesync.record_change('package-%d' % i, True)
+        model.Session.commit()
+        config['ckanext.oaipmh.resourcesync.changelist_size'] = '2'
+        try:
+            assert resourcesync.publish() == (5, 2)
+        finally:
+            del config['ckanext.oaipmh.resourcesync.changelist_size']
+
+        locs = self._locs(resourcesync.CHANGE_LIST)
+        assert len(locs) == 2, locs
+        assert locs[-1].endswith('identifier=package-4'), locs
+        # The older changes are dropped from the log
+        assert model.Session.query(oaipmh_model.ResourceChange).count() == 2
+
+
+class TestSingleFlight(TestCase):
+
+    def test_normalize_oai_args(self):
+        assert normalize_oai_args({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}) == \
+            normalize_oai_args({'metadataPrefix': 'oai_dc', 'verb': 'ListRecords'})
+        assert normalize_oai_args({'verb': 'ListRecords', 'set': 'a'}) != \
+            normalize_oai_args({'verb': 'ListRecords', 'set': 'b'})
+
+    def test_concurrent_calls_share_result(self):
+        single_flight = SingleFlight()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'response'
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do('key', compute)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1, calls
+        assert results == ['response'] * 5, results
+
+    def test_sequential_calls_recompute(self):
+        single_flight = SingleFlight()
+        calls = []
+        single_flight.do('key', lambda: calls.append(1))
+        single_flight.do('key', lambda: calls.append(1))
+        assert len(calls) == 2, calls
+
+    def test_error_is_shared(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError('failed')
+
+        self.assertRaises(ValueError, single_flight.do, 'key', fail)
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def _create(self):
+        self.calls.append(1)
+        return '<OAI-PMH/>'
+
+    def test_cached_response(self):
+        params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'set': 'test-cache'}
+        assert cache.cached_response(params, self._create) == '<OAI-PMH/>'
+        assert cache.cached_response(dict(params), self._create) == '<OAI-PMH/>'
+        assert len(self.calls) == 1, self.calls
+
+        cache.cached_response(dict(params, set='other'), self._create)
+        assert len(self.calls) == 2, self.calls
+
+    def test_bump_catalogue_version(self):
+        params = {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc', 'set': 'test-bump'}
+        cache.cached_response(params, self._create)
+        cache.bump_catalogue_version()
+        cache.cached_response(params, self._create)
+        assert len(self.calls) == 2, self.calls
+
+    def test_validator(self):
+        params = {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc', 'set': 'test-validator'}
+        cache.cached_response(params, self._create, validator='etag-1')
+        # Responses with a validator don't depend on the catalogue version
+        cache.bump_catalogue_version()
+        cache.cached_response(params, self._create, validator='etag-1')
+        assert len(self.calls) == 1, self.calls
+        cache.cached_response(params, self._create, validator='etag-2')
+        assert len(self.calls) == 2, self.calls
+
+    def test_invalidate_after_commit(self):
+        cache.setup()
+        version = cache.catalogue_version()
+        cache.invalidate_after_commit()
+        model.Session.execute('SELECT 1')
+        assert cache.catalogue_version() == version
+        model.Session.rollback()
+        model.Session.commit()
+        assert cache.catalogue_version() == version
+
+        cache.invalidate_after_commit()
+        model.Session.execute('SELECT 1')
+        model.Session.commit()
+        assert cache.catalogue_version() != version
+
+
+class TestPrecompute(TestCase):
+
+    params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'set': 'test-precompute'}
+    next_params = {'verb': 'ListRecords', 'resumptionToken': 'test-precompute-2'}
+
+    def setUp(self):
+        self.rendered = []
+        self.replacer = testfixtures.Replacer()
+        self.replacer.replace('ckanext.oaipmh.controller.handle_request', self._render)
+        config['ckanext.oaipmh.precompute.workers'] = '1'
+        cache.bump_catalogue_version()
+
+    def tearDown(self):
+        self.replacer.restore()
+        del config['ckanext.oaipmh.precompute.workers']
+
+    def _render(self, parms, validator=None):
+        self.rendered.append(parms.get('resumptionToken'))
+        if parms.get('resumptionToken'):
+            return '<OAI-PMH/>'
+        return '<OAI-PMH><resumptionToken>%s</resumptionToken></OAI-PMH>' % self.next_params['resumptionToken']
+
+    def _wait_for(self, count):
+        for _ in range(50):
+            if len(self.rendered) >= count:
+                return
+            time.sleep(0.1)
+
+    def test_precompute_into_cache(self):
+        controller.cached_page(dict(self.params))
+        self._wait_for(2)
+        assert self.rendered == [None, 'test-precompute-2'], self.rendered
+
+        # Cache hits of both pages render nothing, not even in the background
+        controller.cached_page(dict(self.params))
+        assert controller.cached_page(dict(self.next_params)) == '<OAI-PMH/>'
+        time.sleep(0.2)
+        assert self.rendered == [None, 'test-precompute-2'], self.rendered
+
+
+class TestWorkerContext(TestCase):
+
+    def test_worker_context(self):
+        def task():
+            return pylons.request.host_url, pylons.tmpl_context.user
+
+        # A task runs within a blank request to the site, not the request it
+        # was submitted from
+        host_url, user = workers.get_executor('test-worker-context', 1).submit(task).result()
+        assert (config.get('ckan.site_url') or 'http://localhost').startswith(host_url), host_url
+        assert not user, user
+
+
+class TestCKANServer(TestCase):
+
+    def tearDown(self):
+        config.pop('ckanext.oaipmh.extras.exclude', None)
+
+    def test_extra_key_patterns(self):
+        config['ckanext.oaipmh.extras.exclude'] = 'xpath* pids_?_type 100%'
+        patterns = CKANServer._extra_key_patterns('ckanext.oaipmh.extras.exclude')
+        assert patterns == ['xpath%', 'pids\\__\\_type', '100\\%'], patterns
+
+    def test_extra_key_patterns_empty(self):
+        assert CKANServer._extra_key_patterns('ckanext.oaipmh.extras.exclude') == []
+
+
+class TestTransport(TestCase):
+
+    DATA = b'<OAI-PMH>' + b'x' * 1000 + b'</OAI-PMH>'
+
+    def test_decompress(self):
+        gzip = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        assert decompress(gzip.compress(self.DATA) + gzip.flush(), 'gzip') == self.DATA
+        assert decompress(zlib.compress(self.DATA), 'deflate') == self.DATA
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        assert decompress(raw.compress(self.DATA) + raw.flush(), 'deflate') == self.DATA
+        assert decompress(self.DATA, None) == self.DATA
+
+    def test_file_url(self):
+        registry = create_metadata_registry()
+        client = TransportClient("file://%s" % _get_fixture('listidentifiers.xml'), registry)
+        identifiers = [header.identifier() for header in client.listIdentifiers(metadataPrefix='oai_dc')]
+        assert 'oai:arXiv.org:hep-th/9801001' in identifiers, identifiers
+
+    @contextmanager
+    def _server(self):
+        requests = []
+        data = self.DATA
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _reply(self):
+                if self.command == 'POST':
+                    self.rfile.read(int(self.headers['Content-Length']))
+                requests.append((self.command, self.path))
+                if self.path.startswith('/old'):
+                    self.send_response(301)
+                    self.send_header('Location', '/oai')
+                elif self.path.startswith('/loop'):
+                    self.send_response(302)
+                    self.send_header('Location', '/loop')
+                elif self.path.startswith('/busy') and len(requests) == 1:
+                    self.send_response(503)
+                    self.send_header('Retry-After', '0')
+                else:
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_GET = do_POST = _reply
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            yield 'http://127.0.0.1:%d' % server.server_address[1], requests
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+    def test_redirect(self):
+        with self._server() as (base_url, requests):
+            transport = HTTPTransport()
+            # A redirected POST is repeated as a GET with the arguments in the query
+            assert transport.request(base_url + '/old', 'verb=Identify') == self.DATA
+            assert requests == [('POST', '/old'), ('GET', '/oai?verb=Identify')], requests
+            self.assertRaises(urllib.error.HTTPError, transport.request, base_url + '/loop')
+            assert len(requests) == 2 + transport.max_redirects + 1, requests
+
+    def test_retry_after(self):
+        with self._server() as (base_url, requests):
+            client = TransportClient(base_url + '/busy', create_metadata_registry())
+            assert client.makeRequest(verb='Identify') == self.DATA
+            assert len(requests) == 2, requests
+
+    def test_proxy(self):
+        with self._server() as (base_url, requests):
+            environ = {'http_proxy': base_url, 'no_proxy': 'localhost'}
+            with mock.patch.dict(os.environ, environ):
+                os.environ.pop('NO_PROXY', None)
+                transport = HTTPTransport()
+                assert transport.request('http://oai.example.org/oai?verb=Identify') == self.DATA
+            assert requests == [('GET', 'http://oai.example.org/oai?verb=Identify')], requests
+            assert not transport._idle
+
+    def test_failure_not_retried(self):
+        class Connection(object):
+            closed = False
+
+            def request(self, *args):
+                raise ConnectionResetError()
+
+            def close(self):
+                self.closed = True
+
+        transport = HTTPTransport()
+        stale, expired = Connection(), Connection()
+        transport._idle[('http', 'oai.example.org')] = [(expired, time.time() - transport.idle_timeout),
+                                                        (stale, time.time())]
+        # The failure is left to the request policy, even on a reused connection
+        self.assertRaises(ConnectionResetError, transport.request, 'http://oai.example.org/oai')
+        assert stale.closed
+        assert not transport._idle[('http', 'oai.example.org')]
+        with mock.patch.object(transport, '_connect', return_value=Connection()):
+            self.assertRaises(ConnectionResetError, transport.request, 'http://oai.example.org/oai')
+        assert expired.closed
+
+
+class TestAdaptiveLimiter(TestCase):
+
+    def test_increase(self):
+        limiter = AdaptiveLimiter(4, initial=1)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(0.1)
+        assert limiter.limit == 4, limiter.limit
+
+    def test_decrease_on_error(self):
+        limiter = AdaptiveLimiter(8, initial=8)
+        limiter.acquire()
+        limiter.release(0.1, error=True)
+        assert limiter.limit == 4, limiter.limit
+
+    def test_decrease_on_slowdown(self):
+        limiter = AdaptiveLimiter(8, initial=8)
+        limiter.acquire()
+        limiter.release(0.1)
+        limiter.acquire()
+        limiter.release(1.0)
+        assert limiter.limit == 4, limiter.limit
+
+    def test_concurrency(self):
+        limiter = AdaptiveLimiter(2, initial=2)
+        in_flight = []
+
+        def request():
+            limiter.acquire()
+            in_flight.append(limiter.in_flight)
+            time.sleep(0.05)
+            limiter.release(0.05)
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert max(in_flight) <= 2, in_flight
+
+
+class _FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _http_error(code, retry_after=None):
+    headers = {'Retry-After': retry_after} if retry_after else {}
+    return urllib.error.HTTPError('http://example.com/oai', code, 'Error', headers, None)
+
+
+class TestRequestPolicy(TestCase):
+
+    def _policy(self, **kwargs):
+        clock = _FakeClock()
+        return RequestPolicy(sleep=clock.sleep, clock=clock, **kwargs), clock
+
+    def _failing(self, errors):
+        errors = list(errors)
+
+        def request():
+            if errors:
+                raise errors.pop(0)
+            return 'response'
+        return request
+
+    def test_retry_transient(self):
+        policy, clock = self._policy(retries=3, backoff=1.0)
+        result = policy.call(self._failing([_http_error(503), IOError('timed out')]))
+        assert result == 'response'
+        assert len(clock.sleeps) == 2, clock.sleeps
+        assert clock.sleeps[1] <= 2.0, clock.sleeps
+        assert policy.failures == 0
+
+    def test_no_retry_on_client_error(self):
+        policy, clock = self._policy()
+        self.assertRaises(urllib.error.HTTPError, policy.call, self._failing([_http_error(404)]))
+        assert clock.sleeps == []
+
+    def test_give_up(self):
+        policy, clock = self._policy(retries=2, failure_threshold=10)
+        self.assertRaises(IOError, policy.call, self._failing([IOError()] * 3))
+        assert len(clock.sleeps) == 2, clock.sleeps
+
+    def test_retry_after(self):
+        policy, clock = self._policy()
+        assert policy.call(self._failing([_http_error(503, '120')])) == 'response'
+        assert clock.now >= 120, clock.now
+
+    def test_circuit_breaker(self):
+        policy, clock = self._policy(retries=0, failure_threshold=2, cooldown=30)
+        for _ in range(2):
+            self.assertRaises(IOError, policy.call, self._failing([IOError()]))
+        assert policy.open_until == clock.now + 30
+        # The trial request after the cooldown fails and doubles the cooldown
+        self.assertRaises(IOError, policy.call, self._failing([IOError()]))
+        assert policy.open_until == clock.now + 60
+        assert policy.call(self._failing([])) == 'response'
+        assert policy.open_until is None
+
+
+class _FakeSetClient():
+    def __init__(self, sets):
+        self.sets = sets
+
+    def listIdentifiers(self, **kwargs):
+        if kwargs['set'] == 'fail':
+            raise IOError('Connection reset')
+        return [_FakeIdentifier(identifier) for identifier in self.sets[kwargs['set']]]
+
+
+class _FakePartitionHarvester():
+    def __init__(self, sets):
+        self.sets = sets
+
+    def create_client(self, url, registry):
+        return _FakeSetClient(self.sets)
+
+
+class TestPartitions(TestCase):
+
+    def test_date_windows(self):
+        start = datetime.datetime(2016, 1, 1, 12)
+        windows = date_windows(start, 10, True, datetime.datetime(2016, 1, 25))
+        self.assertEquals(windows, [
+            (datetime.datetime(2016, 1, 1), datetime.datetime(2016, 1, 10)),
+            (datetime.datetime(2016, 1, 11), datetime.datetime(2016, 1, 20)),
+            (datetime.datetime(2016, 1, 21), datetime.datetime(2016, 1, 25))])
+
+        windows = date_windows(start, 10)
+        self.assertEquals(windows[0], (start, start + datetime.timedelta(days=10, seconds=-1)))
+        self.assertEquals(windows[-1][1], None)
+
+    def test_list_partitions(self):
+        sets = dict(('set%d' % number, ['%d-%d' % (number, item) for item in range(50)]) for number in range(4))
+        partitions = [(set_spec, {'set': set_spec}) for set_spec in sorted(sets)]
+        items = list(list_partitions(_FakePartitionHarvester(sets), partitions, 'http://localhost', None, 2,
+                                     queue_size=5))
+        self.assertEquals(sorted(identifier for _set_spec, identifier, _datestamp in items),
+                          sorted(identifier for identifiers in sets.values() for identifier in identifiers))
+        assert all(identifier.startswith(set_spec[3:] + '-') for set_spec, identifier, _datestamp in items)
+
+    def test_list_partitions_error(self):
+        sets = {'set0': ['a', 'b']}
+        partitions = [('set0', {'set': 'set0'}), ('fail', {'set': 'fail'})]
+        self.assertRaises(IOError, list, list_partitions(_FakePartitionHarvester(sets), partitions,
+                                                         'http://localhost', None, 2))
+
+
+class _FakeIndexer():
+    def __init__(self):
+        self.batches = []
+
+    def index(self, package_ids):
+        self.batches.append(package_ids)
+
+
+class TestDeferredIndexing(TestCase):
+
+    def test_batches(self):
+        indexer = _FakeIndexer()
+        with DeferredIndexing(indexer, batch_size=2) as deferred:
+            for package_id in 'a', 'a', 'b', 'c':
+                deferred.add(package_id)
+            self.assertEquals(indexer.batches, [['a', 'b']])
+            self.assertFalse(ckan.plugins.plugin_loaded('synchronous_search'))
+        self.assertEquals(indexer.batches, [['a', 'b'], ['c']])
+        self.assertTrue(ckan.plugins.plugin_loaded('synchronous_search'))
+
+    def test_nested(self):
+        with DeferredIndexing(_FakeIndexer()):
+            with DeferredIndexing(_FakeIndexer()):
+                pass
+            self.assertFalse(ckan.plugins.plugin_loaded('synchronous_search'))
+        self.assertTrue(ckan.plugins.plugin_loaded('synchronous_search'))
+
+    def test_written(self):
+        indexer = _FakeIndexer()
+        with DeferredIndexing(indexer):
+            package = model.Package(name='test-deferred-indexing')
+            model.Session.add(package)
+            model.Session.flush()
+            package_id = package.id
+            model.Session.rollback()
+        # The indexer skips the datasets whose write was rolled back
+        self.assertEquals(indexer.batches, [[package_id]])
+
+    def test_max_delay(self):
+        indexer = _FakeIndexer()
+        with DeferredIndexing(indexer, max_delay=0.1) as deferred:
+            deferred.collect(['a'])
+            deferred._timer.join()
+            self.assertEquals(indexer.batches, [['a']])
+        self.assertEquals(indexer.batches, [['a']])
@@ -0,0 +1,228 @@
+'''Pooled HTTP transport for the harvester's OAI-PMH clients.
+
+`oaipmh.client.Client` opens a new connection for every request and does
+not ask for compression. :class:`HTTPTransport` keeps idle keep-alive
+connections per host, sends ``Accept-Encoding: gzip, deflate`` and
+decompresses the replies. Requests to hosts behind a proxy from the
+``http_proxy``/``https_proxy``/``no_proxy`` environment go through urllib.
+:class:`TransportClient` is an `oaipmh.client.Client` that sends its
+requests through a transport, following a
+:class:`~ckanext.oaipmh.policy.RequestPolicy`, which makes all retries.
+'''
+import http.client
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+import oaipmh.client
+
+from ckanext.oaipmh.policy import RequestPolicy
+
+log = logging.getLogger(__name__)
+
+USER_AGENT = 'ckanext-oaipmh'
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+def decompress(data, encoding):
+    '''Decode a response body with the given Content-Encoding.'''
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    '''Leave redirects to :meth:`HTTPTransport.request`.'''
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class HTTPTransport(object):
+    '''Thread safe HTTP client keeping keep-alive connections per host.
+    Failed requests aren't retried, that's left to the request policy of
+    the caller.
+
+    :param timeout: socket timeout in seconds
+    :param max_idle: maximum number of idle connections kept per host
+    :param max_redirects: maximum number of redirects followed per request
+    :param idle_timeout: seconds an idle connection is kept, shorter than
+        the keep-alive timeout of most servers so that few requests are
+        sent on connections the server has closed
+    '''
+
+    def __init__(self, timeout=60, max_idle=4, max_redirects=5, idle_timeout=4):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_redirects = max_redirects
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _checkout(self, key):
+        expired = []
+        connection = None
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle and connection is None:
+                candidate, since = idle.pop()
+                if time.time() - since < self.idle_timeout:
+                    connection = candidate
+                else:
+                    expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        return connection or self._connect(*key)
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def close(self):
+        '''Close all idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _since in connections:
+                connection.close()
+
+    @staticmethod
+    def _headers(data, headers):
+        request_headers = {'User-Agent': USER_AGENT,
+                           'Accept-Encoding': 'gzip, deflate'}
+        if data is not None:
+            request_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        request_headers.update(headers or {})
+        return request_headers
+
+    @staticmethod
+    def _proxied(parts):
+        '''Whether a request to the URL goes through a proxy of the
+        environment.
+        '''
+        return parts.scheme in urllib.request.getproxies() and \
+            not urllib.request.proxy_bypass(parts.hostname or '')
+
+    def _send_proxied(self, url, data, headers):
+        '''Send a request through urllib, which uses the proxies of the
+        environment, without keep-alive.
+        '''
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler(), _NoRedirect())
+        request = urllib.request.Request(url, data.encode('utf-8') if data is not None else None,
+                                         self._headers(data, headers))
+        try:
+            response = opener.open(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            response = e
+        try:
+            return response.code, response.reason, response.headers, response.read()
+        finally:
+            response.close()
+
+    def _send(self, url, data, headers):
+        '''Send a request without following redirects.
+
+        :returns: status, reason, headers and body of the response
+        '''
+        parts = urllib.parse.urlsplit(url)
+        if self._proxied(parts):
+            return self._send_proxied(url, data, headers)
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        request_headers = dict(self._headers(data, headers), Connection='keep-alive')
+
+        connection = self._checkout(key)
+        try:
+            connection.request('POST' if data is not None else 'GET', path, data, request_headers)
+            response = connection.getresponse()
+            body = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+        return response.status, response.reason, response.msg, body
+
+    def request(self, url, data=None, headers=None):
+        '''Send a GET request, or a POST request if `data` is given, and
+        return the decompressed response body. Redirects are followed up to
+        `max_redirects` times. A POST redirected with 301, 302 or 303 is
+        repeated as a GET with `data` in the query string.
+
+        :param url: http or https URL
+        :param data: urlencoded form data
+        :param headers: additional request headers
+        :raises urllib.error.HTTPError: if the final response status is not
+            200, or there are too many redirects
+        '''
+        for _redirect in range(self.max_redirects + 1):
+            status, reason, response_headers, body = self._send(url, data, headers)
+            location = response_headers.get('Location')
+            if status not in REDIRECT_STATUSES or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+            if data is not None and status not in (307, 308):
+                url = '%s%s%s' % (url, '&' if '?' in url else '?', data)
+                data = None
+            log.debug('Redirected to %s', url)
+        else:
+            raise urllib.error.HTTPError(url, status, 'Too many redirects', response_headers, None)
+
+        if status != 200:
+            raise urllib.error.HTTPError(url, status, reason, response_headers, None)
+        return decompress(body, response_headers.get('Content-Encoding'))
+
+
+class TransportClient(oaipmh.client.Client):
+    '''OAI-PMH client sending its requests through an
+    :class:`HTTPTransport`. Non-HTTP base URLs, e.g. ``file://`` fixtures,
+    are read as by `oaipmh.client.Client`.
+
+    :param transport: the :class:`HTTPTransport` to use
+    :param policy: `RequestPolicy` of the source for retries and circuit
+        breaking. By default the client has a policy of its own, which
+        like `oaipmh.client.Client` waits for a 503 with ``Retry-After``.
+    '''
+
+    def __init__(self, base_url, metadata_registry=None, transport=None, policy=None, **kwargs):
+        super(TransportClient, self).__init__(base_url, metadata_registry, **kwargs)
+        self.transport = transport or HTTPTransport()
+        self.policy = policy or RequestPolicy()
+
+    def makeRequest(self, **kw):
+        if self._local_file or urllib.parse.urlsplit(self._base_url).scheme not in ('http', 'https'):
+            return super(TransportClient, self).makeRequest(**kw)
+        headers = {}
+        if self._credentials is not None:
+            headers['Authorization'] = 'Basic ' + self._credentials.strip()
+        data = urllib.parse.urlencode(kw)
+        if self._force_http_get:
+            separator = '&' if '?' in self._base_url else '?'
+            request = lambda: self.transport.request(self._base_url + separator + data, headers=headers)
+        else:
+            request = lambda: self.transport.request(self._base_url, data, headers=headers)
+        return self.policy.call(request)
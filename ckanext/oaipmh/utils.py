@@ -1,3 +1,6 @@
+import threading
+import zlib
+
 from iso639 import languages
 
 import ckan.model as model
@@ -28,3 +31,73 @@ def get_earliest_datestamp():
 
     return model.Session.query(model.Package.metadata_modified).\
         order_by(model.Package.metadata_modified).first()[0]
+
+
+def normalize_oai_args(params):
+    '''
+    Return a hashable, order independent key of OAI-PMH request arguments,
+    so that equivalent requests map to the same key.
+    '''
+
+    return tuple(sorted((key, tuple(value) if isinstance(value, list) else value)
+                        for key, value in params.items()))
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Coalesce concurrent calls with the same key: the first caller runs the
+    function, the others wait for it and share its result or exception.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+def compress(chunks, encoding):
+    '''
+    Compress an iterable of response chunks with the 'gzip' or 'deflate'
+    content coding, yielding compressed chunks. The OAI-PMH responses are
+    built in full, so the controller passes the whole page as one chunk.
+    '''
+
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,107 @@
+'''Bounded background workers for the OAI-PMH server.
+
+Work run outside of a request, like the precomputation of a page after
+its request has finished, can't use the globals of any request. A worker
+runs each task within a :func:`worker_context`, with Pylons and Routes
+globals of a fresh blank request to the site (for `url_for` and actions)
+and its own database session.
+'''
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import pylons
+from pylons.util import AttribSafeContextObj
+from routes import request_config
+from webob import Request
+
+from ckan import model
+from ckan.lib.app_globals import app_globals
+from ckan.lib.cli import MockTranslator
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+
+@contextmanager
+def worker_context():
+    '''Set up the Pylons and Routes globals of a blank GET request to
+    ``ckan.site_url`` in the current (worker) thread. The thread's database
+    session is removed when done.
+    '''
+    request = Request.blank('/', base_url=config.get('ckan.site_url') or 'http://localhost')
+    objects = [(pylons.request, request),
+               (pylons.tmpl_context, AttribSafeContextObj()),
+               (pylons.app_globals, app_globals),
+               (pylons.translator, MockTranslator())]
+    for proxy, obj in objects:
+        proxy._push_object(obj)
+    routes_config = request_config()
+    mapper = config.get('routes.map')
+    if mapper is not None:
+        routes_config.mapper = mapper
+        routes_config.environ = request.environ
+    try:
+        yield
+    finally:
+        model.Session.remove()
+        for proxy, obj in reversed(objects):
+            proxy._pop_object(obj)
+
+
+class BoundedExecutor(object):
+    '''Thread pool with a bound on the number of queued and running tasks.
+    Every task runs within a :func:`worker_context`, independent of the
+    request it was submitted from.
+    '''
+
+    def __init__(self, max_workers, max_pending=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers)
+
+    def _run(self, function, args):
+        with worker_context():
+            return function(*args)
+
+    def _submit(self, function, args):
+        try:
+            future = self._executor.submit(self._run, function, args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def submit(self, function, *args):
+        '''Submit a task, waiting for a free slot.
+
+        :rtype: concurrent.futures.Future
+        '''
+        self._slots.acquire()
+        return self._submit(function, args)
+
+    def try_submit(self, function, *args):
+        '''Submit a task if there is a free slot.
+
+        :returns: the future of the task or None if the executor is full
+        '''
+        if not self._slots.acquire(False):
+            return None
+        return self._submit(function, args)
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name, max_workers, max_pending=None):
+    '''Return the process wide executor called `name`, creating it on first
+    use.
+
+    :rtype: BoundedExecutor
+    '''
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = BoundedExecutor(max_workers, max_pending)
+        return _executors[name]